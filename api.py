@@ -0,0 +1,234 @@
+'''Read only JSON API for machine clients.
+
+    GET /api/posts                       newest posts, cursor paged
+    GET /api/posts?ids=1,2,3             posts by ID with one batch get
+    GET /api/posts/<id>                  one post with its first comments
+    GET /api/posts/<id>/comments         cursor paged comments of a post
+
+List and detail requests take fields=title,created,like_count,... to pick
+the returned post fields, and paged requests take limit and cursor.  Every
+response carries an ETag and answers If-None-Match with 304 Not Modified.
+'''
+
+import hashlib
+import json
+
+import webapp2
+
+import storage
+
+POST_FIELDS = ("id", "title", "content", "user_id", "author", "created",
+               "last_modified", "like_count", "tags")
+LIST_FIELDS = ("id", "title", "author", "created", "like_count")
+DETAIL_FIELDS = POST_FIELDS
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+CACHE_SECONDS = 60
+
+
+class ApiError(Exception):
+    '''Client error returned as a JSON body with an HTTP status
+
+    Attributes:
+        status: Int HTTP status code
+        message: String description of the problem
+    '''
+
+    def __init__(self, message, status = 400):
+        Exception.__init__(self, message)
+        self.message = message
+        self.status = status
+
+
+def _time(value):
+    return value and value.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def post_dict(post, fields, authors):
+    '''Returns the requested fields of a Post as a JSON ready dict
+
+    Args:
+        post: Post entity
+        fields: list of String field names from POST_FIELDS
+        authors: dict of Int user ID to User, used for "author"
+
+    Returns:
+        dict of field name to value
+    '''
+    values = {
+        "id": lambda: post.key().id(),
+        "title": lambda: post.title,
+        "content": lambda: post.content,
+        "user_id": lambda: post.user_id,
+        "author": lambda: _username(authors, post.user_id),
+        "created": lambda: _time(post.created),
+        "last_modified": lambda: _time(post.last_modified),
+        "like_count": lambda: post.like_count(),
+        "tags": lambda: list(post.tags),
+    }
+    return dict((f, values[f]()) for f in fields)
+
+
+def comment_dict(comment, authors):
+    return {"id": comment.key().id(),
+            "user_id": comment.user_id,
+            "author": _username(authors, comment.user_id),
+            "content": comment.content,
+            "created": _time(comment.created)}
+
+
+def _username(authors, uid):
+    u = authors.get(uid)
+    return u and u.username
+
+
+class ApiHandler(webapp2.RequestHandler):
+    '''Base for JSON API handlers
+
+    Methods:
+        handle_exception: turns ApiError into a JSON error response
+        write_json: writes a compact JSON body with ETag and caching headers
+        get_fields: parses the fields parameter
+        get_limit: parses the limit parameter
+        get_authors: loads the Users for a list of IDs with one batch get
+        get_post: returns a Post by ID or raises a 404 ApiError
+    '''
+
+    def initialize(self, *a, **kw):
+        webapp2.RequestHandler.initialize(self, *a, **kw)
+        self.storage = storage.get_backend()
+
+    def handle_exception(self, exception, debug):
+        if isinstance(exception, ApiError):
+            self.write_json({"error": exception.message},
+                            status = exception.status)
+        elif isinstance(exception, storage.InvalidCursorError):
+            self.write_json({"error": "Invalid cursor"}, status = 400)
+        else:
+            webapp2.RequestHandler.handle_exception(self, exception, debug)
+
+    def write_json(self, obj, status = 200):
+        '''Writes obj as compact JSON
+
+        Successful responses get a strong ETag from the body and are
+        publicly cacheable for CACHE_SECONDS.  A request whose If-None-Match
+        matches the ETag gets 304 with no body.
+
+        Args:
+            obj: JSON serializable object
+            status: Int HTTP status code
+
+        Returns:
+            None
+        '''
+        body = json.dumps(obj, separators = (",", ":"), sort_keys = True)
+        self.response.headers["Content-Type"] = "application/json"
+        if status != 200:
+            self.response.set_status(status)
+            self.response.headers["Cache-Control"] = "no-cache"
+            self.response.out.write(body)
+            return
+
+        etag = hashlib.md5(body).hexdigest()
+        self.response.etag = etag
+        self.response.headers["Cache-Control"] = (
+            "public, max-age=%d" % CACHE_SECONDS)
+        if etag in self.request.if_none_match:
+            del self.response.headers["Content-Type"]
+            self.response.set_status(304)
+            return
+        self.response.out.write(body)
+
+    def get_fields(self, default):
+        raw = self.request.get("fields")
+        if not raw:
+            return list(default)
+        fields = [f for f in raw.split(",") if f]
+        unknown = [f for f in fields if f not in POST_FIELDS]
+        if unknown:
+            raise ApiError("Unknown fields: %s" % ",".join(unknown))
+        return fields
+
+    def get_limit(self):
+        raw = self.request.get("limit")
+        if not raw:
+            return DEFAULT_LIMIT
+        if not raw.isdigit() or not 0 < int(raw) <= MAX_LIMIT:
+            raise ApiError("limit must be 1 to %d" % MAX_LIMIT)
+        return int(raw)
+
+    def get_authors(self, uids):
+        uids = sorted(set(uids))
+        return dict(zip(uids, self.storage.get_users(uids)))
+
+    def get_post(self, post_id):
+        post = self.storage.get_post(post_id)
+        if not post:
+            raise ApiError("Post not found", status = 404)
+        return post
+
+
+class PostList(ApiHandler):
+    '''GET /api/posts, newest first or by ids=1,2,3'''
+
+    def get(self):
+        fields = self.get_fields(LIST_FIELDS)
+        ids = self.request.get("ids")
+        if ids:
+            try:
+                post_ids = [int(i) for i in ids.split(",") if i]
+            except ValueError:
+                raise ApiError("ids must be a comma separated list of IDs")
+            if not all(storage.valid_id(i) for i in post_ids):
+                raise ApiError("ids must be 1 to %d" % storage.MAX_ID)
+            if len(post_ids) > MAX_LIMIT:
+                raise ApiError("At most %d ids per request" % MAX_LIMIT)
+            posts = [p for p in self.storage.get_posts(post_ids) if p]
+            next_cursor = None
+        else:
+            posts, next_cursor = self.storage.recent_posts_page(
+                self.get_limit(), self.request.get("cursor") or None)
+
+        authors = {}
+        if "author" in fields:
+            authors = self.get_authors(p.user_id for p in posts)
+        self.write_json({"posts": [post_dict(p, fields, authors)
+                                   for p in posts],
+                         "cursor": next_cursor})
+
+
+class PostDetail(ApiHandler):
+    '''GET /api/posts/<id>, the post with its first page of comments'''
+
+    def get(self, post_id):
+        fields = self.get_fields(DETAIL_FIELDS)
+        post = self.get_post(post_id)
+        comments, next_cursor = self.storage.comments_page(
+            post, self.get_limit())
+        uids = [c.user_id for c in comments]
+        if "author" in fields:
+            uids.append(post.user_id)
+        authors = self.get_authors(uids)
+        self.write_json({"post": post_dict(post, fields, authors),
+                         "comments": [comment_dict(c, authors)
+                                      for c in comments],
+                         "comments_cursor": next_cursor})
+
+
+class PostComments(ApiHandler):
+    '''GET /api/posts/<id>/comments, cursor paged comments of a post'''
+
+    def get(self, post_id):
+        post = self.get_post(post_id)
+        comments, next_cursor = self.storage.comments_page(
+            post, self.get_limit(), self.request.get("cursor") or None)
+        authors = self.get_authors(c.user_id for c in comments)
+        self.write_json({"comments": [comment_dict(c, authors)
+                                      for c in comments],
+                         "cursor": next_cursor})
+
+
+routes = [("/api/posts/?", PostList),
+          ("/api/posts/([0-9]+)", PostDetail),
+          ("/api/posts/([0-9]+)/comments", PostComments)]
@@ -0,0 +1,57 @@
+import base64
+
+import pytest
+
+import storage
+
+
+def make_post(s, title = "Title"):
+    u = s.user_by_name("alice") or s.register_user("alice", "Passw0rd")
+    return s.create_post(title, "Body", u.key().id())
+
+
+def test_posts_by_ids_with_fields(backend, app):
+    a = make_post(backend, "A")
+    b = make_post(backend, "B")
+    ids = "%d,%d,999" % (b.key().id(), a.key().id())
+    response = app.get("/api/posts?ids=%s&fields=title,author,like_count"
+                       % ids)
+    assert response.json["posts"] == [
+        {"title": "B", "author": "alice", "like_count": 1},
+        {"title": "A", "author": "alice", "like_count": 1}]
+
+
+def test_comments_are_cursor_paged(backend, app):
+    p = make_post(backend)
+    for i in range(3):
+        backend.create_comment(p, p.user_id, "c%d" % i)
+    url = "/api/posts/%d/comments?limit=2" % p.key().id()
+
+    first = app.get(url).json
+    assert [c["content"] for c in first["comments"]] == ["c2", "c1"]
+    second = app.get(url + "&cursor=" + first["cursor"]).json
+    assert [c["content"] for c in second["comments"]] == ["c0"]
+    assert second["cursor"] is None
+
+
+def test_etag_and_errors(backend, app):
+    p = make_post(backend)
+    url = "/api/posts/%d" % p.key().id()
+    etag = app.get(url).headers["ETag"]
+    assert app.get(url, headers = {"If-None-Match": etag},
+                   status = 304).body == ""
+
+    assert app.get("/api/posts/999", status = 404).json["error"]
+    assert app.get("/api/posts?fields=password", status = 400)
+    assert app.get("/api/posts?cursor=bogus", status = 400)
+
+
+def test_ids_outside_64_bits(backend, app):
+    huge = 2 ** 64
+    assert app.get("/api/posts?ids=%d" % huge, status = 400).json["error"]
+    assert app.get("/api/posts/%d" % huge, status = 404)
+    assert app.get("/api/posts/%d/comments" % huge, status = 404)
+    assert backend.get_posts([1, huge]) == [None, None]
+    cursor = base64.urlsafe_b64encode("2016-01-01 00:00:00.000000|%d" % huge)
+    with pytest.raises(storage.InvalidCursorError):
+        backend.recent_posts_page(2, cursor)
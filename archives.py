@@ -0,0 +1,108 @@
+'''Resumable recount of the tag and month archive counts on the datastore.
+
+ArchiveRecount walks every Post with a mapper.Mapper, so the recount is
+checkpointed and throttled, and can run in chained deferred tasks instead of
+a single request that App Engine would cut off at 60 seconds.
+
+Each batch stores its partial counts in an ArchiveTally keyed by the
+mapper run and the first Post of the batch, so a batch mapped twice after a
+crash overwrites its own tally instead of counting twice.  Once every Post
+has been read, finish() sums the run's tallies, writes the new
+ArchiveCounts and only then deletes stale ones, so an interrupted recount
+never leaves the listing counts wiped.  Tallies a superseded run writes
+after a restart are never summed.
+
+Posts written while a recount runs may or may not be in its totals, so run
+it when few posts are being written.  Running it again repairs any drift.
+'''
+
+import json
+
+from google.appengine.ext import db
+
+import data
+import mapper
+import storage
+
+JOB_NAME = "rebuild_archive_counts"
+BATCH_SIZE = 500
+# Posts read per second when running in the background
+MAX_PER_SECOND = 1000
+
+
+class ArchiveTally(db.Model):
+    '''Archive counts of one batch of Posts.  key_name is the run ID and
+    the batch's first Post key
+
+    Attributes:
+        run_id: String mapper run the batch was counted by
+        counts: Text JSON dict of archive name to Int posts in the batch
+    '''
+
+    run_id = db.StringProperty(required = True)
+    counts = db.TextProperty(required = True)
+
+
+def _delete_all(query, batch_size):
+    keys = []
+    for key in query.run(batch_size = batch_size):
+        keys.append(key)
+        if len(keys) == batch_size:
+            db.delete(keys)
+            keys = []
+    if keys:
+        db.delete(keys)
+
+
+class ArchiveRecount(mapper.Mapper):
+    '''Recounts every month and tag archive from all Posts
+
+    inherits from mapper.Mapper
+
+    Attributes:
+        totals: dict of String name to Int count written by finish(), or
+            None until the recount finishes
+
+    Methods:
+        reset: deletes the checkpoint and all tallies to start over
+        finish: writes the summed tallies as the new ArchiveCounts
+    '''
+
+    def __init__(self, batch_size = BATCH_SIZE,
+                 max_per_second = MAX_PER_SECOND):
+        mapper.Mapper.__init__(self, JOB_NAME, data.Post, None,
+                               batch_size = batch_size,
+                               max_per_second = max_per_second)
+        self.totals = None
+
+    def _map_batch(self, posts):
+        if not posts:
+            return []
+        counts = {}
+        for p in posts:
+            for name in storage.archive_names(p.created, p.tags):
+                counts[name] = counts.get(name, 0) + 1
+        key_name = "%s:%s" % (self.run_id, posts[0].key())
+        return [ArchiveTally(key_name = key_name, run_id = self.run_id,
+                             counts = json.dumps(counts))]
+
+    def reset(self):
+        mapper.Mapper.reset(self)
+        _delete_all(ArchiveTally.all(keys_only = True), self.batch_size)
+
+    def finish(self):
+        totals = {}
+        tallies = ArchiveTally.all().filter("run_id =", self.run_id)
+        for tally in tallies.run(batch_size = self.batch_size):
+            for name, n in json.loads(tally.counts).items():
+                totals[name] = totals.get(name, 0) + n
+        counts = [data.ArchiveCount(key_name = name, count = n)
+                  for name, n in totals.items()]
+        for i in xrange(0, len(counts), self.batch_size):
+            db.put(counts[i:i + self.batch_size])
+
+        stale = [k for k in data.ArchiveCount.all(keys_only = True).run(
+            batch_size = self.batch_size) if k.name() not in totals]
+        for i in xrange(0, len(stale), self.batch_size):
+            db.delete(stale[i:i + self.batch_size])
+        self.totals = totals
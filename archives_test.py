@@ -0,0 +1,82 @@
+import pytest
+
+import main
+import storage
+
+
+@pytest.fixture
+def uid(backend):
+    return backend.register_user("alice", "Passw0rd").key().id()
+
+
+def test_parse_tags():
+    assert main.parse_tags(" Python, app-engine,,python ") == (
+        ["python", "app-engine"], None)
+    assert main.parse_tags("no spaces")[1]
+    assert main.parse_tags(",".join(str(i) for i in range(11)))[1]
+
+
+def test_tag_pages_are_cursor_paged_and_counted(backend, app, uid):
+    s = backend
+    for i in range(12):
+        s.create_post("P%d" % i, "Body", uid, ["python"])
+    s.create_post("Other", "Body", uid, ["misc"])
+
+    first = app.get("/blog/tag/python")
+    assert "P11" in first and "P2" in first and "P1<" not in first
+    assert '<span class="badge">12</span>' in first
+    cursor = first.html.find("a", text = "Older Posts")["href"]
+    second = app.get("/blog/tag/python" + cursor)
+    assert "P1<" in second and "P0" in second and "Other" not in second
+    assert app.get("/blog/tag/python?cursor=bogus", status = 400)
+
+
+def test_counts_follow_edits_and_deletes(backend, uid):
+    s = backend
+    p = s.create_post("A", "Body", uid, ["a", "b"])
+    month = "month:%s" % p.created.strftime("%Y-%m")
+    p.tags = ["b", "c"]
+    s.save_post(p)
+    assert s.archive_counts(["tag:a", "tag:b", "tag:c", month]) == {
+        "tag:a": 0, "tag:b": 1, "tag:c": 1, month: 1}
+    assert s.posts_by_tag("a", 10)[0] == []
+
+    s.delete_post(s.get_post(p.key().id()))
+    assert s.archive_counts(["tag:b", month]) == {"tag:b": 0, month: 0}
+    s.create_post("B", "Body", uid, ["d"])
+    assert s.rebuild_archive_counts() == {"tag:d": 1, month: 1}
+
+
+def test_author_and_month_pages(backend, app, uid):
+    p = backend.create_post("Mine", "Body", uid)
+    assert "Mine" in app.get("/blog/author/alice")
+    assert app.get("/blog/author/nobody", status = 404)
+    assert "Mine" in app.get(p.created.strftime("/blog/%Y/%m"))
+    assert "Mine" not in app.get("/blog/2001/01")
+    assert app.get("/blog/2001/13", status = 404)
+
+
+def test_rebuild_needs_cron_or_admin(app):
+    app.get("/tasks/rebuild_archives", status = 403)
+
+
+def test_datastore_recount_resumes_and_keeps_counts_until_done(backend, uid):
+    if not isinstance(backend, storage.DatastoreStorage):
+        pytest.skip("datastore recount only")
+    import archives
+    import data
+    for i in range(5):
+        backend.create_post("P%d" % i, "Body", uid, ["t%d" % (i % 2)])
+    data.ArchiveCount(key_name = "tag:gone", count = 3).put()
+
+    recount = archives.ArchiveRecount(batch_size = 2, max_per_second = None)
+    recount.reset()
+    assert not recount.run(deadline = 0).done
+    assert backend.archive_counts(["tag:gone"]) == {"tag:gone": 3}
+
+    # A new process picks up from the checkpoint
+    recount = archives.ArchiveRecount(batch_size = 2, max_per_second = None)
+    assert recount.run().done
+    assert backend.archive_counts(["tag:t0", "tag:t1", "tag:gone"]) == {
+        "tag:t0": 3, "tag:t1": 2, "tag:gone": 0}
+    assert sum(recount.totals.values()) == 10
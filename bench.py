@@ -0,0 +1,157 @@
+'''Benchmarks for the blog on the SQLite storage backend.
+
+    $ python bench.py cold_start --runs 5 --posts 50
+    $ python bench.py cold_start --runs 5 --snapshot big.json.gz
+
+cold_start starts a fresh interpreter per run and times importing main,
+the /_ah/warmup request and the first and second /blog requests, once
+with a warmup request and once without, then reports the medians.  With
+--snapshot the database is loaded from a fixtures.py snapshot instead of
+being seeded with --posts posts.
+'''
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def _median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def _ms(start):
+    return (time.time() - start) * 1000.0
+
+
+def cold_start_child(warmup):
+    '''Runs inside a fresh interpreter and prints timings as JSON
+
+    Args:
+        warmup: Boolean.  If True send /_ah/warmup before the first request
+
+    Returns:
+        None
+    '''
+    timings = {}
+    start = time.time()
+    import main
+    import webob
+    timings["import_ms"] = _ms(start)
+
+    t = time.time()
+    if warmup:
+        webob.Request.blank("/_ah/warmup").get_response(main.app)
+    timings["warmup_ms"] = _ms(t)
+
+    t = time.time()
+    status = webob.Request.blank("/blog").get_response(main.app).status_int
+    timings["first_request_ms"] = _ms(t)
+    timings["cold_start_ms"] = _ms(start) - timings["warmup_ms"]
+
+    t = time.time()
+    webob.Request.blank("/blog").get_response(main.app)
+    timings["second_request_ms"] = _ms(t)
+    timings["status"] = status
+    sys.stdout.write(json.dumps(timings))
+
+
+def seed(path, posts):
+    '''Creates a SQLite database with one user and posts posts'''
+    import sqlite_storage
+    s = sqlite_storage.SqliteStorage(path)
+    u = s.register_user("bench", "Passw0rd")
+    for i in xrange(posts):
+        s.create_post("Post %d" % i, "Benchmark content\n" * 20,
+                      u.key().id())
+    s.pool.close()
+
+
+def load_snapshot(path, snapshot):
+    '''Creates a SQLite database from a fixtures.py snapshot'''
+    import fixtures
+    import sqlite_storage
+    s = sqlite_storage.SqliteStorage(path)
+    fixtures.load_snapshot(snapshot, s)
+    s.pool.close()
+
+
+def cold_start(runs, posts, snapshot = None):
+    '''Measures cold start with and without a warmup request
+
+    Args:
+        runs: Int number of fresh interpreters per mode
+        posts: Int number of posts in the seeded database
+        snapshot: String path of a fixtures.py snapshot to load instead,
+            or None
+
+    Returns:
+        dict of mode name to dict of median timings in milliseconds
+    '''
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, "bench.db")
+        if snapshot:
+            load_snapshot(path, snapshot)
+        else:
+            seed(path, posts)
+        env = dict(os.environ, BLOG_STORAGE = "sqlite",
+                   BLOG_SQLITE_PATH = path)
+        results = {}
+        for mode in ("no_warmup", "warmup"):
+            samples = []
+            for i in xrange(runs):
+                cmd = [sys.executable, os.path.join(ROOT, "bench.py"),
+                       "_cold_start_child"]
+                if mode == "warmup":
+                    cmd.append("--warmup")
+                t = time.time()
+                out = subprocess.check_output(cmd, env = env, cwd = ROOT)
+                timings = json.loads(out)
+                timings["process_ms"] = _ms(t)
+                samples.append(timings)
+            results[mode] = dict(
+                (name, _median([s[name] for s in samples]))
+                for name in samples[0] if name != "status")
+        return results
+    finally:
+        shutil.rmtree(tmp)
+
+
+def report(results):
+    names = ["process_ms", "import_ms", "warmup_ms", "first_request_ms",
+             "second_request_ms", "cold_start_ms"]
+    print("%-20s %12s %12s" % ("median (ms)", "no_warmup", "warmup"))
+    for name in names:
+        print("%-20s %12.1f %12.1f" % (name, results["no_warmup"][name],
+                                       results["warmup"][name]))
+
+
+def main_args(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest = "command")
+    cold = sub.add_parser("cold_start", help = "time new instance startup")
+    cold.add_argument("--runs", type = int, default = 5)
+    cold.add_argument("--posts", type = int, default = 50)
+    cold.add_argument("--snapshot", help = "fixtures.py snapshot to load")
+    child = sub.add_parser("_cold_start_child")
+    child.add_argument("--warmup", action = "store_true")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = main_args()
+    if args.command == "_cold_start_child":
+        cold_start_child(args.warmup)
+    elif args.command == "cold_start":
+        report(cold_start(args.runs, args.posts, args.snapshot))
@@ -0,0 +1,142 @@
+'''Shared cache client: App Engine memcache, or an in-process fallback.
+
+client() returns the memcache module when the App Engine SDK is available
+and a LocalCache otherwise, for example under serve.py.  Both support the
+subset of the memcache API used here: get, set, add, incr and delete.
+cas_client() does the same for compare-and-set, which memcache only offers
+on a Client object.
+'''
+
+import threading
+import time
+
+try:
+    from google.appengine.api import memcache
+except ImportError:
+    memcache = None
+
+
+class LocalCache(object):
+    '''Thread safe in-process cache with per key expiry
+
+    Mirrors the memcache functions it replaces.  Time arguments are
+    seconds from now, 0 meaning never expire.  gets and cas work like
+    memcache.Client's, remembering what each thread last read.
+    '''
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._version = 0
+        self._read = threading.local()
+
+    def _live(self, key, now):
+        item = self._data.get(key)
+        if item and item[1] and item[1] <= now:
+            del self._data[key]
+            return None
+        return item
+
+    def get(self, key):
+        with self._lock:
+            item = self._live(key, _now())
+        return item and item[0]
+
+    def _store(self, key, value, time):
+        self._data[key] = (value, _expires(time))
+        self._version += 1
+        self._versions[key] = self._version
+
+    def set(self, key, value, time = 0):
+        with self._lock:
+            self._store(key, value, time)
+        return True
+
+    def add(self, key, value, time = 0):
+        with self._lock:
+            if self._live(key, _now()):
+                return False
+            self._store(key, value, time)
+        return True
+
+    def gets(self, key):
+        with self._lock:
+            item = self._live(key, _now())
+            if not hasattr(self._read, "versions"):
+                self._read.versions = {}
+            self._read.versions[key] = item and self._versions.get(key)
+        return item and item[0]
+
+    def cas(self, key, value, time = 0):
+        read = getattr(self._read, "versions", {}).pop(key, None)
+        with self._lock:
+            if not read or not self._live(key, _now()):
+                return False
+            if self._versions.get(key) != read:
+                return False
+            self._store(key, value, time)
+        return True
+
+    def incr(self, key, delta = 1, initial_value = None):
+        with self._lock:
+            item = self._live(key, _now())
+            if item is None:
+                if initial_value is None:
+                    return None
+                item = (initial_value, 0)
+            value = item[0] + delta
+            self._data[key] = (value, item[1])
+            self._version += 1
+            self._versions[key] = self._version
+        return value
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._versions.pop(key, None)
+        return True
+
+    def flush_all(self):
+        with self._lock:
+            self._data.clear()
+            self._versions.clear()
+        return True
+
+
+def _now():
+    return time.time()
+
+
+def _expires(seconds):
+    return seconds and _now() + seconds
+
+
+local = LocalCache()
+
+
+def client():
+    '''Returns the cache to use in this process
+
+    Args:
+        None
+
+    Returns:
+        memcache module on App Engine, else the shared LocalCache
+    '''
+    return memcache or local
+
+
+def cas_client():
+    '''Returns a cache supporting gets and cas
+
+    Args:
+        None
+
+    Returns:
+        new memcache.Client on App Engine, else the shared LocalCache.
+        A memcache.Client must not be shared between threads
+    '''
+    if memcache:
+        return memcache.Client()
+    return local
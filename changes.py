@@ -0,0 +1,111 @@
+'''Per-post change versions for the live comment and like feed.
+
+Every edit, like and comment change bumps the post's change version in
+storage (see save_post, create_comment and save_comment in the backends).
+Handlers then publish() the new version to the shared cache, and
+wait_for_change() polls only the cache while a long-poll request waits.
+Storage is read once when the cache has no version, and again each time the
+short lived cache entry expires, so an instance that missed a publish is
+never stale for long.
+
+A waiting request holds a server thread (or an App Engine concurrent
+request slot), so each process parks at most MAX_WAITERS of them at once,
+WAITER_SHARE of the threads it serves requests on.  Polls beyond that are
+answered at once and told to come back after BUSY_RETRY_AFTER seconds,
+which keeps threads free for page reads.
+'''
+
+import threading
+import time
+
+import cache
+
+KEY = "post_version:%d"
+# Seconds a cached version is trusted before it is read from storage again
+VERSION_TTL = 5
+POLL_INTERVAL = 0.5
+MAX_WAIT = 25
+# Changed comments returned per response
+MAX_COMMENTS = 100
+# Requests an App Engine instance serves at once, the max_concurrent_requests
+# default.  serve.py calls set_threads() with its --threads instead
+INSTANCE_THREADS = 10
+# Share of those threads long polls may hold
+WAITER_SHARE = 0.5
+# Seconds clients that found no free slot wait before polling again
+BUSY_RETRY_AFTER = 10
+
+MAX_WAITERS = None
+waiters = None
+
+
+def set_threads(threads):
+    '''Sizes the long poll limit to the threads a process serves requests on
+
+    Args:
+        threads: Int concurrent requests the process serves
+
+    Returns:
+        Int new MAX_WAITERS
+    '''
+    global MAX_WAITERS, waiters
+    MAX_WAITERS = max(1, int(threads * WAITER_SHARE))
+    waiters = threading.BoundedSemaphore(MAX_WAITERS)
+    return MAX_WAITERS
+
+
+set_threads(INSTANCE_THREADS)
+
+
+def publish(post_id, version):
+    '''Announces a new change version for a post
+
+    Args:
+        post_id: Int post ID
+        version: Int change version from storage
+
+    Returns:
+        None
+    '''
+    cache.client().set(KEY % int(post_id), version, time = VERSION_TTL)
+
+
+def current_version(backend, post_id):
+    '''Returns the newest known change version for a post
+
+    Args:
+        backend: storage backend, read when the cache has no version
+        post_id: Int post ID
+
+    Returns:
+        Int change version, or None if the post does not exist
+    '''
+    version = cache.client().get(KEY % int(post_id))
+    if version is None:
+        post = backend.get_post(post_id)
+        if not post:
+            return None
+        version = post.version
+        publish(post_id, version)
+    return version
+
+
+def wait_for_change(backend, post_id, since, timeout = MAX_WAIT):
+    '''Waits until a post's change version passes since
+
+    Args:
+        backend: storage backend
+        post_id: Int post ID
+        since: Int change version the client already has
+        timeout: Float seconds to wait.  0 checks once
+
+    Returns:
+        Int current change version, or None if the post does not exist.
+        Not greater than since if nothing changed before the timeout
+    '''
+    deadline = time.time() + timeout
+    while True:
+        version = current_version(backend, post_id)
+        if version is None or version > since or time.time() >= deadline:
+            return version
+        time.sleep(POLL_INTERVAL)
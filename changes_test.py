@@ -0,0 +1,111 @@
+import threading
+import time
+
+import pytest
+import webtest
+
+import changes
+import main
+
+AJAX = {"X-Requested-With": "XMLHttpRequest"}
+
+
+@pytest.fixture
+def post_url(app):
+    app.post("/blog/signup", {"username": "bob", "pwd1": "Passw0rd",
+                              "pwd2": "Passw0rd"})
+    return app.post("/blog/newpost", {"title": "Hello",
+                                      "content": "World"}).location
+
+
+def get_changes(app, post_url, since):
+    return app.get(post_url + "/changes",
+                   {"since": since, "wait": 0}).json
+
+
+def test_nothing_changed_returns_current_version(app, post_url):
+    assert get_changes(app, post_url, 0) == {"version": 0}
+
+
+def test_comments_and_likes_are_returned_once(app, post_url):
+    added = app.post(post_url, {"action": "add_comment",
+                                "comment_content": "First!"},
+                     headers = AJAX).json
+    assert added == {"version": 1}
+
+    result = get_changes(app, post_url, 0)
+    assert result["version"] == 1
+    assert result["like_count"] == 1
+    assert len(result["comments"]) == 1
+    assert "First!" in result["comments"][0]["html"]
+
+    comment_id = str(result["comments"][0]["id"])
+    app.post(post_url, {"edit_comment": comment_id, comment_id: "Edited"})
+    result = get_changes(app, post_url, 1)
+    assert result["version"] == 2
+    assert "Edited" in result["comments"][0]["html"]
+    assert get_changes(app, post_url, 2) == {"version": 2}
+
+
+def test_unknown_post_and_bad_since(app, post_url):
+    app.get("/blog/999/changes", {"since": 0, "wait": 0}, status = 404)
+    app.get(post_url + "/changes", {"since": "x"}, status = 400)
+    app.get("/blog/%d/changes" % 2 ** 64, {"since": 0, "wait": 0},
+            status = 404)
+    app.get(post_url + "/changes", {"since": -2 ** 64}, status = 400)
+
+
+def test_full_waiter_slots_do_not_block_reads(app, post_url, monkeypatch):
+    monkeypatch.setattr(changes, "POLL_INTERVAL", 0.01)
+    monkeypatch.setattr(changes, "waiters", threading.BoundedSemaphore(
+        changes.MAX_WAITERS))
+    wait_for_change = changes.wait_for_change
+    parked = []
+
+    def counted(backend, post_id, since, timeout):
+        if timeout:
+            parked.append(post_id)
+        return wait_for_change(backend, post_id, since, timeout)
+    monkeypatch.setattr(changes, "wait_for_change", counted)
+
+    pollers = [threading.Thread(
+        target = webtest.TestApp(main.app).get,
+        args = (post_url + "/changes", {"since": 0, "wait": 1}))
+        for i in range(changes.MAX_WAITERS)]
+    for t in pollers:
+        t.start()
+    while len(parked) < changes.MAX_WAITERS:
+        time.sleep(0.01)
+
+    started = time.time()
+    busy = app.get(post_url + "/changes", {"since": 0})
+    assert busy.json == {"version": 0}
+    assert busy.headers["Retry-After"] == str(changes.BUSY_RETRY_AFTER)
+    assert "Hello" in app.get("/blog")
+    assert time.time() - started < 0.5
+    for t in pollers:
+        t.join()
+
+
+def test_waiters_follow_the_thread_budget(monkeypatch):
+    monkeypatch.setattr(changes, "MAX_WAITERS", changes.MAX_WAITERS)
+    monkeypatch.setattr(changes, "waiters", changes.waiters)
+    assert changes.set_threads(16) == 8
+    assert changes.set_threads(1) == 1
+    assert changes.waiters.acquire(False)
+    assert not changes.waiters.acquire(False)
+
+
+def test_deleted_comments_are_announced(app, post_url):
+    app.post(post_url, {"action": "add_comment", "comment_content": "Oops"},
+             headers = AJAX)
+    comment_id = get_changes(app, post_url, 0)["comments"][0]["id"]
+
+    deleted = app.post(post_url, {"delete_comment": str(comment_id)},
+                       headers = AJAX).json
+    assert deleted == {"version": 2}
+    result = get_changes(app, post_url, 1)
+    assert result["version"] == 2
+    assert result["comments"] == []
+    assert result["deleted"] == [comment_id]
+    assert "Oops" not in app.get(post_url)
@@ -0,0 +1,78 @@
+'''Shared test fixtures.
+
+Tests that take the backend fixture run once per storage backend: SQLite
+in memory, and the datastore on the App Engine testbed stubs.  The
+datastore runs are skipped when the App Engine SDK is not installed.
+Tests of datastore only modules take the datastore fixture instead.
+'''
+
+import pytest
+import webtest
+
+import cache
+import main
+import storage
+import sqlite_storage
+
+try:
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+except ImportError:
+    testbed = None
+
+BACKENDS = ["sqlite", "datastore"]
+
+
+def _testbed(request):
+    '''Returns an active testbed with the memcache stub, or None without
+    the SDK'''
+    if not testbed:
+        return None
+    # cache.client() is memcache whenever the SDK is importable
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.init_memcache_stub()
+    request.addfinalizer(tb.deactivate)
+    return tb
+
+
+def _init_datastore(tb):
+    # Queries see every committed write, like SQLite
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability = 1)
+    tb.init_datastore_v3_stub(consistency_policy = policy)
+    tb.init_taskqueue_stub()
+
+
+@pytest.fixture(params = BACKENDS)
+def backend(request):
+    '''Returns a fresh, empty storage backend set as the process backend'''
+    tb = _testbed(request)
+    if request.param == "datastore":
+        if not tb:
+            pytest.skip("App Engine SDK not installed")
+        _init_datastore(tb)
+        s = storage.DatastoreStorage()
+    else:
+        s = sqlite_storage.SqliteStorage(":memory:", pool_size = 1)
+    storage.set_backend(s)
+    request.addfinalizer(lambda: storage.set_backend(None))
+    cache.local.flush_all()
+    return s
+
+
+@pytest.fixture
+def datastore(request):
+    '''Returns an active testbed with empty datastore, memcache and task
+    queue stubs, for tests of datastore only modules'''
+    tb = _testbed(request)
+    if not tb:
+        pytest.skip("App Engine SDK not installed")
+    _init_datastore(tb)
+    return tb
+
+
+@pytest.fixture
+def app(backend):
+    '''Returns a webtest.TestApp of main.app on the backend fixture'''
+    return webtest.TestApp(main.app)
@@ -0,0 +1,198 @@
+'''Write-behind post view counters and the popular posts leaderboard.
+
+Viewing a post never writes to storage.  record_view() only adds the hit
+to an in-process buffer.  On App Engine, once FLUSH_INTERVAL seconds have
+passed (or the buffer holds FLUSH_SIZE posts) the request that notices
+hands all buffered counts to one deferred task, which writes them in a
+batch off the request path.  serve.py has no task queue, so it flushes the
+buffer from a thread every FLUSH_INTERVAL seconds instead.
+
+refresh_leaderboard() runs on a schedule (cron on App Engine, a thread
+under serve.py).  It computes the top posts and caches them, so
+popular_posts() costs no storage reads on the request path.
+'''
+
+import logging
+import threading
+import time
+
+import cache
+import storage
+
+try:
+    from google.appengine.ext import deferred
+except ImportError:
+    deferred = None
+
+FLUSH_INTERVAL = 10
+FLUSH_SIZE = 500
+
+LEADERBOARD_KEY = "leaderboard:popular_posts"
+LEADERBOARD_SIZE = 5
+LEADERBOARD_TTL = 60 * 60
+# Seconds a process reuses the leaderboard before asking the cache again
+LOCAL_TTL = 30
+
+
+class ViewBuffer(object):
+    '''Buffers post views in memory and flushes them in batches
+
+    Attributes:
+        flush_interval: Int seconds between flushes
+        flush_size: Int number of distinct posts that forces a flush
+        defer: Boolean.  If True record() hands due views to a deferred
+            task.  If False views wait for flush() to be called
+
+    Methods:
+        record: counts one view of a post, deferring a flush when due
+        enqueue: hands all buffered views to a deferred task
+        flush: writes all buffered views to the storage backend
+    '''
+
+    def __init__(self, flush_interval = FLUSH_INTERVAL,
+                 flush_size = FLUSH_SIZE, defer = deferred is not None):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.defer = defer
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+
+    def record(self, post_id, views = 1):
+        with self._lock:
+            self._pending[post_id] = self._pending.get(post_id, 0) + views
+            due = self.defer and (
+                len(self._pending) >= self.flush_size or
+                time.time() - self._last_flush >= self.flush_interval)
+        if due:
+            self.enqueue()
+
+    def _take_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.time()
+        return pending
+
+    def _put_back(self, views):
+        with self._lock:
+            for post_id, n in views.items():
+                self._pending[post_id] = self._pending.get(post_id, 0) + n
+
+    def enqueue(self):
+        '''Hands all buffered views to a deferred write_views task
+
+        Costs one task queue call instead of the storage writes.  If the
+        task cannot be added the views go back in the buffer.
+
+        Args:
+            None
+
+        Returns:
+            Int number of posts handed off
+        '''
+        pending = self._take_pending()
+        if not pending:
+            return 0
+        try:
+            deferred.defer(write_views, pending)
+        except Exception:
+            logging.exception("Failed to defer views for %d posts",
+                              len(pending))
+            self._put_back(pending)
+            return 0
+        return len(pending)
+
+    def flush(self):
+        '''Writes all buffered views to the storage backend
+
+        Views that were not written are put back in the buffer, so a
+        storage error never fails the caller.
+
+        Args:
+            None
+
+        Returns:
+            Int number of posts flushed
+        '''
+        pending = self._take_pending()
+        if not pending:
+            return 0
+        try:
+            failed = storage.get_backend().add_views(pending)
+        except Exception:
+            logging.exception("Failed to flush views for %d posts",
+                              len(pending))
+            failed = pending
+        if failed:
+            self._put_back(failed)
+        return len(pending) - len(failed)
+
+
+def write_views(views):
+    '''Writes view counts handed off by ViewBuffer.enqueue, as a task
+
+    Views that were not written are deferred again rather than failing the
+    task, since retrying it would count the written ones twice.
+
+    Args:
+        views: dict of Int post ID to Int views
+
+    Returns:
+        None
+    '''
+    failed = storage.get_backend().add_views(views)
+    if failed:
+        logging.warning("Deferring views for %d posts again", len(failed))
+        deferred.defer(write_views, failed, _countdown = FLUSH_INTERVAL)
+
+
+view_buffer = ViewBuffer()
+
+_popular = None
+_popular_expires = 0
+
+
+def record_view(post_id):
+    view_buffer.record(int(post_id))
+
+
+def flush_views():
+    return view_buffer.flush()
+
+
+def refresh_leaderboard(limit = LEADERBOARD_SIZE):
+    '''Computes the most viewed posts and stores them in the cache
+
+    Args:
+        limit: Int number of posts on the leaderboard
+
+    Returns:
+        list of dicts with id, title and views, most viewed first
+    '''
+    global _popular, _popular_expires
+    backend = storage.get_backend()
+    top = backend.top_viewed(limit)
+    posts = backend.get_posts([pid for pid, n in top])
+    board = [{"id": pid, "title": p.title, "views": n}
+             for (pid, n), p in zip(top, posts) if p]
+    cache.client().set(LEADERBOARD_KEY, board, time = LEADERBOARD_TTL)
+    _popular, _popular_expires = board, time.time() + LOCAL_TTL
+    return board
+
+
+def popular_posts():
+    '''Returns the cached leaderboard without touching storage
+
+    Args:
+        None
+
+    Returns:
+        list of dicts with id, title and views.  Empty until the first
+        refresh_leaderboard()
+    '''
+    global _popular, _popular_expires
+    now = time.time()
+    if _popular is None or now >= _popular_expires:
+        _popular = cache.client().get(LEADERBOARD_KEY) or []
+        _popular_expires = now + LOCAL_TTL
+    return _popular
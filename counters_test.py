@@ -0,0 +1,132 @@
+import pytest
+
+import counters
+import main
+import storage
+
+
+@pytest.fixture(autouse = True)
+def forget_popular():
+    counters._popular = None
+
+
+def test_views_are_buffered_until_flush(backend):
+    s = backend
+    buf = counters.ViewBuffer(flush_interval = 0, flush_size = 1,
+                              defer = False)
+    buf.record(1)
+    buf.record(1)
+    buf.record(2)
+    assert s.view_counts([1, 2]) == {1: 0, 2: 0}
+
+    assert buf.flush() == 2
+    assert s.view_counts([1, 2]) == {1: 2, 2: 1}
+
+
+class FakeDeferred(object):
+    '''Collects deferred calls so tests can run them'''
+
+    def __init__(self):
+        self.tasks = []
+
+    def defer(self, fn, *args, **kw):
+        self.tasks.append((fn, args))
+
+
+def test_due_views_are_written_by_a_task(backend, monkeypatch):
+    s = backend
+    fake = FakeDeferred()
+    monkeypatch.setattr(counters, "deferred", fake)
+    buf = counters.ViewBuffer(flush_interval = 3600, flush_size = 3,
+                              defer = True)
+    buf.record(1)
+    buf.record(1)
+    buf.record(2)
+    buf.record(3)
+    # The viewing request only queued the write
+    assert s.view_counts([1, 2, 3]) == {1: 0, 2: 0, 3: 0}
+    assert len(fake.tasks) == 1
+
+    fn, args = fake.tasks.pop()
+    fn(*args)
+    assert s.view_counts([1, 2, 3]) == {1: 2, 2: 1, 3: 1}
+    assert not fake.tasks
+
+
+def test_leaderboard_is_served_from_cache(backend, app):
+    s = backend
+    u = s.register_user("alice", "Passw0rd")
+    a = s.create_post("Quiet", "Body", u.key().id())
+    b = s.create_post("Popular", "Body", u.key().id())
+    s.add_views({a.key().id(): 1, b.key().id(): 5})
+
+    board = counters.refresh_leaderboard()
+    assert [p["title"] for p in board] == ["Popular", "Quiet"]
+
+    storage.set_backend(None)
+    counters._popular = None
+    assert counters.popular_posts() == board
+
+    storage.set_backend(s)
+    assert "Popular Posts" in app.get("/blog")
+
+
+def test_views_add_up_across_transactions(backend, monkeypatch):
+    monkeypatch.setattr(storage.random, "randrange", lambda n: 3)
+    post_ids = range(1, storage.MAX_XG_GROUPS + 6)
+    assert backend.add_views(dict((pid, 1) for pid in post_ids)) == {}
+    assert backend.add_views(dict((pid, 2) for pid in post_ids)) == {}
+    assert backend.view_counts(post_ids) == dict((pid, 3) for pid in post_ids)
+
+
+def datastore_only(backend):
+    if not isinstance(backend, storage.DatastoreStorage):
+        pytest.skip("datastore transactions only")
+
+
+def test_concurrent_flush_to_a_shard_is_not_lost(backend, monkeypatch):
+    datastore_only(backend)
+    monkeypatch.setattr(storage.random, "randrange", lambda n: 3)
+    backend.add_views({1: 1})
+    add = backend._add_shard_views
+    raced = []
+
+    def racing(post_ids, shard, deltas):
+        if not raced:
+            # Another instance flushes the same shard mid transaction
+            raced.append(True)
+            backend.db.non_transactional(backend.add_views)({1: 10})
+        return add(post_ids, shard, deltas)
+    monkeypatch.setattr(backend, "_add_shard_views", racing)
+
+    assert backend.add_views({1: 100}) == {}
+    assert backend.view_counts([1]) == {1: 111}
+
+
+def test_failed_transactions_are_buffered_again(backend, monkeypatch):
+    datastore_only(backend)
+    add = backend._add_shard_views
+    failures = [True]
+
+    def flaky(post_ids, shard, deltas):
+        if failures:
+            failures.pop()
+            raise backend.db.TransactionFailedError()
+        return add(post_ids, shard, deltas)
+    monkeypatch.setattr(backend, "_add_shard_views", flaky)
+
+    buf = counters.ViewBuffer(flush_interval = 3600, flush_size = 1000)
+    post_ids = range(1, storage.MAX_XG_GROUPS + 6)
+    for pid in post_ids:
+        buf.record(pid)
+    assert buf.flush() == 5
+    assert buf.flush() == storage.MAX_XG_GROUPS
+    assert buf.flush() == 0
+    assert backend.view_counts(post_ids) == dict((pid, 1) for pid in post_ids)
+
+
+def test_refresh_needs_cron_or_admin(app):
+    app.get("/tasks/refresh_popular", status = 403)
+    # The cron header is only trusted on App Engine
+    app.get("/tasks/refresh_popular", headers = {"X-Appengine-Cron": "true"},
+            status = 200 if main.users else 403)
@@ -1,4 +1,4 @@
-import main
+import rendering
 import hashing
 
 from google.appengine.ext import db
@@ -12,6 +12,9 @@ class Post(db.Model):
         likes: Int count of the score/likes of the post
         created: DateTime of when the entity was created
         last_modified: DateTime of when the post was last modified
+        version: Int change version.  Bumped on every edit, like and
+                 comment change so clients can fetch only what changed
+        tags: list of String lowercase tags for tag listings
     
     Methods:
         render_overview: renders the shortend post for the main blog page
@@ -24,6 +27,8 @@ class Post(db.Model):
     likes = db.ListProperty(int,indexed=True,default=[])
     created = db.DateTimeProperty(auto_now_add = True)
     last_modified = db.DateTimeProperty(auto_now = True)
+    version = db.IntegerProperty(default = 0)
+    tags = db.StringListProperty(default = [])
 
     def like_count(self):
         return len(self.likes)
@@ -64,8 +69,8 @@ class Post(db.Model):
             String HTML for post data. HTML in data not escaped in template
         '''
         self._render_text = self.content.replace("\n", "<br>")
-        return main.render_str("postoverview.html", p = self,
-                          post_username=User.by_id(self.user_id).username)
+        return rendering.render_str("postoverview.html", p = self,
+                                    post_username=User.by_id(self.user_id).username)
 
 
 class Comment(db.Model):
@@ -77,6 +82,8 @@ class Comment(db.Model):
         user_id: Int the user who wrote the comment. ID matches a User object
         content: Text content to be displayed. Not indexed.
         created: DateTime of when the comment was created
+        version: Int change version of the parent Post when the comment was
+                 last added or edited
     
     Methods:
         get_username: returns the username for the comment based on user_id
@@ -85,6 +92,7 @@ class Comment(db.Model):
     user_id = db.IntegerProperty(required = True)
     content = db.TextProperty(required = True)
     created = db.DateTimeProperty(auto_now_add = True)
+    version = db.IntegerProperty(default = 0)
 
     def get_username(self):
         '''Returns the username for a comment
@@ -98,6 +106,20 @@ class Comment(db.Model):
         return User.by_id(self.user_id).username
 
 
+class DeletedComment(db.Model):
+    '''Records a deleted Comment for the changes feed.
+
+    Child of the Post the comment belonged to, with the comment's ID as its
+    own, so readers with the page open can remove the comment.
+
+    Attributes:
+        version: Int change version of the parent Post when the comment was
+                 deleted
+    '''
+
+    version = db.IntegerProperty(required = True)
+
+
 class User(db.Model):
     '''Defines a User object for the datastore.
 
@@ -186,6 +208,38 @@ class User(db.Model):
             return u
 
 
+class PostViewShard(db.Model):
+    '''Defines one shard of a Post's view counter for the datastore.
+
+    Shards are root entities, outside the blog_key() entity group, with
+    key_name "<post_id>:<shard>".  A post's views are the sum of its shards.
+
+    Attributes:
+        post_id: Int ID of the Post that was viewed
+        views: Int views counted in this shard
+    '''
+
+    post_id = db.IntegerProperty(required = True)
+    views = db.IntegerProperty(default = 0)
+
+    @classmethod
+    def key_for(cls, post_id, shard):
+        return db.Key.from_path(cls.kind(), "%d:%d" % (post_id, shard))
+
+
+class ArchiveCount(db.Model):
+    '''Defines a precomputed post count for a listing page.
+
+    key_name is "tag:<tag>" or "month:<yyyy-mm>".  Kept current by the
+    storage backend whenever a post is created, retagged or deleted.
+
+    Attributes:
+        count: Int number of posts in the listing
+    '''
+
+    count = db.IntegerProperty(default = 0)
+
+
 def users_key(group = "default"):
     '''Gets parent in DB for all users
 
@@ -0,0 +1,351 @@
+'''Seeded synthetic blog data and snapshots for scale testing.
+
+    $ python fixtures.py snapshot big.json.gz --seed 1 --users 5000 \
+          --posts 100000 --hot-posts 3 --max-comments 10000 --max-likes 5000
+    $ python fixtures.py load big.json.gz --db blog.db
+
+generate() yields Users, Posts and Comments from a seed, so the same seed
+and Profile always give the same rows.  Like and comment counts per post
+follow Pareto distributions (most posts get a few, a handful get very many)
+and content lengths are log-normal.  A Profile's hot_posts get exactly
+max_likes likes and max_comments comments, to reproduce the worst posts.
+
+write_snapshot() saves generated rows to a gzipped JSON lines file and
+load() writes rows to any storage backend in batches, so benchmark runs
+can start from identical data without generating it again.  On App Engine,
+load a snapshot into the datastore stub from a testbed.
+'''
+
+import argparse
+import calendar
+import collections
+import datetime
+import gzip
+import json
+import random
+
+import hashing
+
+UserRow = collections.namedtuple(
+    "UserRow", ["id", "username", "password", "email", "created"])
+PostRow = collections.namedtuple(
+    "PostRow", ["id", "user_id", "title", "content", "created", "tags",
+                "likes", "version"])
+CommentRow = collections.namedtuple(
+    "CommentRow", ["id", "post_id", "user_id", "content", "created",
+                   "version"])
+
+# Row kinds in load order, each with its snapshot tag and backend method
+KINDS = [(UserRow, "u", "load_users"),
+         (PostRow, "p", "load_posts"),
+         (CommentRow, "c", "load_comments")]
+
+SNAPSHOT_FORMAT = 1
+BATCH_SIZE = 500
+PASSWORD = "Passw0rd"
+
+WORDS = ("blog post cloud engine python data store query index cache "
+         "request page user comment like tag archive month author write "
+         "read fast slow batch cursor latency memory thread process server "
+         "token bucket snapshot seed random scale test bench load the a "
+         "and of to in is it for on with as at by from this that").split()
+
+
+class Profile(object):
+    '''Sizes and distributions of a generated data set
+
+    Attributes:
+        users: Int number of Users
+        posts: Int number of Posts
+        start: DateTime of the first Post
+        days: Int days the Posts are spread over
+        like_alpha: Float Pareto shape of likes per post.  Smaller values
+            give a longer tail
+        max_likes: Int cap on likes per post, the author's included.  At
+            most users, as each User likes a Post once
+        comment_alpha: Float Pareto shape of comments per post
+        max_comments: Int cap on comments per post
+        hot_posts: Int number of Posts given max_likes and max_comments
+        post_words: (mu, sigma) of the log-normal post length in words
+        comment_words: (mu, sigma) of the log-normal comment length in words
+        tags: Int number of distinct tags.  Posts get up to 3, few
+            tags being far more common than the rest
+
+    Raises:
+        ValueError: max_likes is more than users
+    '''
+
+    def __init__(self, users = 100, posts = 1000,
+                 start = datetime.datetime(2016, 1, 1), days = 365,
+                 like_alpha = 1.2, max_likes = 100, comment_alpha = 1.5,
+                 max_comments = 1000, hot_posts = 0,
+                 post_words = (5.0, 0.8), comment_words = (2.5, 0.7),
+                 tags = 50):
+        if max_likes > users:
+            raise ValueError("max_likes %d is more than the %d users"
+                             % (max_likes, users))
+        self.users = users
+        self.posts = posts
+        self.start = start
+        self.days = days
+        self.like_alpha = like_alpha
+        self.max_likes = max_likes
+        self.comment_alpha = comment_alpha
+        self.max_comments = max_comments
+        self.hot_posts = hot_posts
+        self.post_words = tuple(post_words)
+        self.comment_words = tuple(comment_words)
+        self.tags = tags
+
+    def to_dict(self):
+        d = dict(self.__dict__)
+        d["start"] = _timestamp(self.start)
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        d = dict(d)
+        d["start"] = _datetime(d["start"])
+        return cls(**d)
+
+
+def _timestamp(dt):
+    return calendar.timegm(dt.utctimetuple())
+
+
+def _datetime(ts):
+    return datetime.datetime.utcfromtimestamp(ts)
+
+
+def _username(i):
+    '''Returns a letters only username for a User ID, as Signup requires'''
+    letters = []
+    while i:
+        i, r = divmod(i, 26)
+        letters.append(chr(ord("a") + r))
+    return "user" + "".join(reversed(letters))
+
+
+def _pareto(rng, alpha, cap):
+    '''Returns an Int from 1 to cap, most often small'''
+    return min(cap, int(rng.paretovariate(alpha)))
+
+
+def _text(rng, words, max_words = 5000):
+    mu, sigma = words
+    n = max(1, min(max_words, int(rng.lognormvariate(mu, sigma))))
+    lines = []
+    for i in xrange(0, n, 40):
+        line = " ".join(rng.choice(WORDS) for w in xrange(min(40, n - i)))
+        lines.append(line.capitalize() + ".")
+    return "\n".join(lines)
+
+
+def _tags(rng, profile):
+    tags = set()
+    for i in xrange(rng.randint(0, 3)):
+        tags.add("topic-%d" % (_pareto(rng, 1.0, profile.tags) - 1))
+    return sorted(tags)
+
+
+def generate(seed, profile):
+    '''Yields a data set of Users, then each Post followed by its Comments
+
+    Args:
+        seed: Int random seed
+        profile: Profile of sizes and distributions
+
+    Returns:
+        generator of UserRow, PostRow and CommentRow
+    '''
+    rng = random.Random(seed)
+    user_ids = xrange(1, profile.users + 1)
+    for uid in user_ids:
+        name = _username(uid)
+        salt = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz")
+                       for i in xrange(5))
+        yield UserRow(uid, name, hashing.make_pw_hash(name, PASSWORD, salt),
+                      "%s@example.com" % name,
+                      profile.start - datetime.timedelta(
+                          seconds = rng.randint(1, 86400 * 30)))
+
+    hot = set(rng.sample(xrange(1, profile.posts + 1),
+                         min(profile.hot_posts, profile.posts)))
+    step = profile.days * 86400.0 / max(1, profile.posts)
+    comment_id = 0
+    for post_id in xrange(1, profile.posts + 1):
+        author = rng.choice(user_ids)
+        created = profile.start + datetime.timedelta(
+            seconds = int((post_id - 1 + rng.random()) * step))
+        if post_id in hot:
+            n_likes, n_comments = profile.max_likes, profile.max_comments
+        else:
+            n_likes = _pareto(rng, profile.like_alpha, profile.max_likes)
+            n_comments = _pareto(rng, profile.comment_alpha,
+                                 profile.max_comments + 1) - 1
+        fans = rng.sample(user_ids, n_likes)
+        likes = [author] + [u for u in fans if u != author][:n_likes - 1]
+        title = " ".join(rng.choice(WORDS)
+                         for i in xrange(rng.randint(3, 8))).title()
+        yield PostRow(post_id, author, title,
+                      _text(rng, profile.post_words), created,
+                      _tags(rng, profile), likes, n_comments)
+
+        offsets = sorted(rng.randint(60, 86400 * 30)
+                         for i in xrange(n_comments))
+        for version, offset in enumerate(offsets, 1):
+            comment_id += 1
+            yield CommentRow(comment_id, post_id, rng.choice(user_ids),
+                             _text(rng, profile.comment_words),
+                             created + datetime.timedelta(seconds = offset),
+                             version)
+
+
+def _encode(row):
+    for cls, tag, method in KINDS:
+        if isinstance(row, cls):
+            return [tag] + [_timestamp(v) if isinstance(v, datetime.datetime)
+                            else v for v in row]
+    raise TypeError("Not a fixture row: %r" % (row,))
+
+
+def _decode(values):
+    for cls, tag, method in KINDS:
+        if values[0] == tag:
+            row = cls(*values[1:])
+            return row._replace(created = _datetime(row.created))
+    raise ValueError("Unknown row kind %r" % values[0])
+
+
+def write_snapshot(path, seed, profile):
+    '''Generates a data set into a gzipped JSON lines file
+
+    The first line describes the data set, every other line is one row.
+
+    Args:
+        path: String file path
+        seed: Int random seed
+        profile: Profile of sizes and distributions
+
+    Returns:
+        dict of String row kind to Int rows written
+    '''
+    counts = collections.Counter()
+    f = gzip.open(path, "wb")
+    try:
+        f.write(json.dumps({"format": SNAPSHOT_FORMAT, "seed": seed,
+                            "profile": profile.to_dict()}) + "\n")
+        for row in generate(seed, profile):
+            f.write(json.dumps(_encode(row), separators = (",", ":")) + "\n")
+            counts[type(row).__name__] += 1
+    finally:
+        f.close()
+    return dict(counts)
+
+
+def read_snapshot(path):
+    '''Reads a file written by write_snapshot
+
+    Args:
+        path: String file path
+
+    Returns:
+        (dict header with format, seed and profile, generator of rows)
+
+    Raises:
+        ValueError: the file is from an unknown snapshot format
+    '''
+    f = gzip.open(path, "rb")
+    header = json.loads(f.readline())
+    if header.get("format") != SNAPSHOT_FORMAT:
+        f.close()
+        raise ValueError("Unknown snapshot format %r" % header.get("format"))
+
+    def rows():
+        try:
+            for line in f:
+                yield _decode(json.loads(line))
+        finally:
+            f.close()
+    return header, rows()
+
+
+def load(backend, rows, batch_size = BATCH_SIZE):
+    '''Writes rows to a storage backend in batches
+
+    Rows of each kind are buffered and written batch_size at a time.  A
+    full batch first writes the pending rows of the kinds before it, so
+    Posts always exist before their Comments.  Archive counts are rebuilt
+    at the end.
+
+    Args:
+        backend: storage backend with load_users, load_posts, load_comments
+        rows: iterable of rows from generate() or read_snapshot()
+        batch_size: Int rows per write
+
+    Returns:
+        dict of String row kind to Int rows written
+    '''
+    pending = [[] for k in KINDS]
+    counts = collections.Counter()
+
+    def flush(upto):
+        for i in xrange(upto + 1):
+            if pending[i]:
+                getattr(backend, KINDS[i][2])(pending[i])
+                counts[KINDS[i][0].__name__] += len(pending[i])
+                pending[i] = []
+
+    index = dict((cls, i) for i, (cls, tag, method) in enumerate(KINDS))
+    for row in rows:
+        i = index[type(row)]
+        pending[i].append(row)
+        if len(pending[i]) >= batch_size:
+            flush(i)
+    flush(len(KINDS) - 1)
+    backend.rebuild_archive_counts()
+    return dict(counts)
+
+
+def load_snapshot(path, backend, batch_size = BATCH_SIZE):
+    '''Loads a snapshot file into a storage backend.  See load'''
+    header, rows = read_snapshot(path)
+    return load(backend, rows, batch_size)
+
+
+def main_args(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest = "command")
+    snap = sub.add_parser("snapshot", help = "generate data into a file")
+    snap.add_argument("path")
+    snap.add_argument("--seed", type = int, default = 1)
+    defaults = Profile()
+    for name in ("users", "posts", "days", "max_comments", "hot_posts",
+                 "tags"):
+        snap.add_argument("--" + name.replace("_", "-"), type = int,
+                          default = getattr(defaults, name))
+    snap.add_argument("--max-likes", type = int, default = defaults.max_likes,
+                      help = "cap on likes per post, at most --users")
+    for name in ("like_alpha", "comment_alpha"):
+        snap.add_argument("--" + name.replace("_", "-"), type = float,
+                          default = getattr(defaults, name))
+    snap_load = sub.add_parser("load", help = "load a file into SQLite")
+    snap_load.add_argument("path")
+    snap_load.add_argument("--db", default = "blog.db",
+                           help = "SQLite database file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = main_args()
+    if args.command == "snapshot":
+        try:
+            profile = Profile(**dict((k, v) for k, v in vars(args).items()
+                                     if k not in ("command", "path", "seed")))
+        except ValueError as e:
+            raise SystemExit(e)
+        print(write_snapshot(args.path, args.seed, profile))
+    elif args.command == "load":
+        import sqlite_storage
+        print(load_snapshot(args.path,
+                            sqlite_storage.SqliteStorage(args.db)))
@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+import fixtures
+
+
+def setup_function(function):
+    global tmp
+    tmp = tempfile.mkdtemp()
+
+
+def teardown_function(function):
+    shutil.rmtree(tmp)
+
+
+def test_same_seed_same_rows():
+    profile = fixtures.Profile(users = 20, posts = 50, hot_posts = 1,
+                               max_likes = 15, max_comments = 30)
+    rows = list(fixtures.generate(7, profile))
+    assert rows == list(fixtures.generate(7, profile))
+    assert rows != list(fixtures.generate(8, profile))
+
+    posts = [r for r in rows if isinstance(r, fixtures.PostRow)]
+    assert len(posts) == 50
+    assert max(len(p.likes) for p in posts) == 15
+    assert max(p.version for p in posts) == 30
+    assert all(p.likes[0] == p.user_id and len(set(p.likes)) == len(p.likes)
+               for p in posts)
+
+
+def test_more_likes_than_users():
+    with pytest.raises(ValueError):
+        fixtures.Profile(users = 5, max_likes = 6)
+
+
+def test_snapshot_loads_in_batches(backend):
+    profile = fixtures.Profile(users = 10, posts = 30, hot_posts = 2,
+                               max_likes = 10, max_comments = 25)
+    path = os.path.join(tmp, "snap.json.gz")
+    written = fixtures.write_snapshot(path, 3, profile)
+    header, rows = fixtures.read_snapshot(path)
+    assert header["seed"] == 3
+    assert list(rows) == list(fixtures.generate(3, profile))
+
+    s = backend
+    assert fixtures.load_snapshot(path, s, batch_size = 7) == written
+    user = s.login("userb", fixtures.PASSWORD)
+    assert user and user.key().id() == 1
+
+    post = s.recent_posts(1)[0]
+    assert post.key().id() == 30
+    comments = list(s.get_comments(post))
+    assert len(comments) == post.version
+    months = s.archive_counts(["month:2016-%02d" % m for m in range(1, 13)])
+    assert sum(months.values()) == 30
+
+    # New rows never reuse the loaded IDs
+    assert s.register_user("newbie", "Passw0rd").key().id() > 10
+    assert s.create_post("New", "Body", 1).key().id() > 30
@@ -34,13 +34,165 @@ function editComment(commentId) {
   } else {
       // User edited and clicked 'Save'. Disable editing
       $('#' + commentId + '_comment_content').prop('contenteditable', false);
-      // Find specific form for individual comment
-      var currForm = $('#' + $('#' + commentId + '_edit_btn').val()+'_form');
-      // Create hidden input based on edited comment content.
-      var input = $('<input>').attr('type', 'hidden').attr('name', $('#' + commentId + '_edit_btn').val()).val($('#' + commentId + '_comment_content').html());
-      currForm.append($(input));  // Add hidden input. Editable field isn't in POST
-      return true;
+      // Send the edit without reloading, then fetch the new row
+      var fields = {edit_comment: commentId};
+      fields[commentId] = $('#' + commentId + '_comment_content').html();
+      $.post(location.pathname, fields).done(showOwnChange).fail(showRejection);
+      $('#' + commentId + '_edit_btn').html('Edit');
+      return false;
   }
   // Change Edit button to say Save
   $('#' + commentId + '_edit_btn').html($('#' + commentId + '_edit_btn').html().trim() == 'Edit' ? 'Save' : 'Edit');
 }
+
+/**
+* @description Change version of the post shown on a full post page. Updated
+* as changes from /blog/<id>/changes are applied
+*/
+var changeVersion = 0;
+
+/**
+* @description ID of the post whose changes are polled, and whether polling
+* stopped because the page was hidden
+*/
+var pollPostId = null;
+var pollPaused = false;
+
+/**
+* @description Starts watching the full post page for new comments and likes
+*/
+$(function () {
+    var post = $('#post');
+    if (post.length) {
+        changeVersion = post.data('version');
+        pollPostId = post.data('post-id');
+        pollChanges(pollPostId, 0);
+    }
+});
+
+/**
+* @description Resumes polling when a hidden page is shown again
+*/
+$(document).on('visibilitychange', function () {
+    if (!document.hidden && pollPaused) {
+        pollPaused = false;
+        pollChanges(pollPostId, 0);
+    }
+});
+
+/**
+* @description Long polls the changes feed for a post and applies the result.
+* Pauses while the page is hidden, waits as long as the server asks with
+* Retry-After, backs off after errors and stops if the post was deleted
+* @param {Number} postId ID of the post being viewed
+* @param {Number} failures count of failed polls in a row
+*/
+function pollChanges(postId, failures) {
+    if (document.hidden) {
+        pollPaused = true;
+        return;
+    }
+    $.getJSON('/blog/' + postId + '/changes', {since: changeVersion})
+        .done(function (data, status, xhr) {
+            applyChanges(data);
+            var retry = Number(xhr.getResponseHeader('Retry-After')) || 0;
+            setTimeout(function () { pollChanges(postId, 0); }, retry * 1000);
+        })
+        .fail(function (xhr) {
+            if (xhr.status == 404) {
+                return;
+            }
+            var delay = Math.min(30, Math.pow(2, failures)) * 1000;
+            setTimeout(function () { pollChanges(postId, failures + 1); }, delay);
+        });
+}
+
+/**
+* @description Applies a changes response in place: like count and added,
+* edited or deleted comment rows. Rows being edited by the user are left
+* alone unless deleted
+* @param {Object} data response from /blog/<id>/changes
+*/
+function applyChanges(data) {
+    if (data.version <= changeVersion) {
+        return;
+    }
+    changeVersion = data.version;
+    if (data.like_count !== undefined) {
+        $('.like-count').text(data.like_count);
+    }
+    $.each(data.deleted || [], function (i, commentId) {
+        $('#comment-' + commentId).remove();
+    });
+    $.each(data.comments || [], function (i, comment) {
+        var row = $('#comment-' + comment.id);
+        if (row.length == 0) {
+            $('#comments tbody').prepend(comment.html);
+        } else if (row.find('[contenteditable=true]').length == 0) {
+            row.replaceWith(comment.html);
+        }
+    });
+}
+
+/**
+* @description Shows the user's own like or comment change at once. The next
+* poll may be parked behind other clients, delayed by Retry-After or paused
+* while the page is hidden, so the change is fetched without waiting
+* @param {Object} data response to the change, {version: n}
+*/
+function showOwnChange(data) {
+    if (!pollPostId || !data || data.version <= changeVersion) {
+        return;
+    }
+    $.getJSON('/blog/' + pollPostId + '/changes', {since: changeVersion, wait: 0})
+        .done(applyChanges);
+}
+
+/**
+* @description Sends likes without reloading the page, then shows the new count
+*/
+$(document).on('click', '.like-form button', function (event) {
+    event.preventDefault();
+    $.post(location.pathname, {action: 'like'})
+        .done(showOwnChange)
+        .fail(showRejection);
+});
+
+/**
+* @description Adds comments without reloading the page, then shows the new row
+*/
+$(document).on('submit', '.comment-form', function (event) {
+    event.preventDefault();
+    var text = $(this).find('textarea');
+    $.post(location.pathname, {action: 'add_comment', comment_content: text.val()})
+        .done(function (data) {
+            text.val('');
+            showOwnChange(data);
+        })
+        .fail(showRejection);
+});
+
+/**
+* @description Deletes comments without reloading the page once confirmDelete
+* was accepted, then removes the row
+*/
+$(document).on('click', 'button[name=delete_comment]', function (event) {
+    if (event.isDefaultPrevented()) {
+        return;
+    }
+    event.preventDefault();
+    $.post(location.pathname, {delete_comment: $(this).val()})
+        .done(showOwnChange)
+        .fail(showRejection);
+});
+
+/**
+* @description Tells the user when a like or comment was rate limited or
+* shed, keeping any typed comment
+* @param {Object} xhr failed request
+*/
+function showRejection(xhr) {
+    if (xhr.status == 429 || xhr.status == 503) {
+        alert(xhr.responseText);
+    }
+}
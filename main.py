@@ -1,36 +1,57 @@
 import os
 import re
+import json
 import string
-import jinja2
 import webapp2
-import data
+import api
+import changes
+import counters
+import ratelimit
+import rendering
+import storage
 import hashing
 import logging
 
-template_dir = os.path.join(os.path.dirname(__file__), "templates")
-jinja_env = jinja2.Environment(loader = jinja2.FileSystemLoader(template_dir),
-                               autoescape = True)
+try:
+    from google.appengine.api import users
+except ImportError:
+    users = None
 
-def render_str(template, **params):
-    '''Renders a jinja2 template with params to the browser.
-        
+TAG_PATTERN = re.compile("^[a-z0-9-]{1,30}$")
+MAX_TAGS = 10
+LISTING_PAGE_SIZE = 10
+
+
+def parse_tags(raw):
+    '''Parses a comma separated tag list from a form
+
+    Tags are lowercased and stripped.  Duplicates are dropped.
+    
     Args:
-        template: String template name within the templates folder.  HTML
-        params: name=value combos to send to the template
+        raw: String of tags like "python, App-Engine"
 
     Returns:
-        rendered page
+        (list of String tags, String error or None)
     '''
-    t = jinja_env.get_template(template)
-    return t.render(params)
+    tags = []
+    for t in raw.split(","):
+        t = t.strip().lower()
+        if t and t not in tags:
+            tags.append(t)
+    if len(tags) > MAX_TAGS:
+        return tags, "At most %d tags, please!" % MAX_TAGS
+    if not all(TAG_PATTERN.match(t) for t in tags):
+        return tags, "Tags are 1 to 30 letters, numbers or dashes"
+    return tags, None
 
 
 class BlogHandler(webapp2.RequestHandler):
     '''Helper class for rendering all pages via handlers
     
     Attributes:
-        None
-    
+        storage: backend from storage.get_backend() for all entity access
+        user: logged in User for the request, or None
+
     Methods:
         initialize: reads username cookie on all requests. sets self.user
         write: write out string to browser
@@ -48,8 +69,9 @@ class BlogHandler(webapp2.RequestHandler):
         Called before every request in appengine
         '''
         webapp2.RequestHandler.initialize(self, *a, **kw)
+        self.storage = storage.get_backend()
         uid = self.read_secure_cookie("username")
-        self.user = uid and data.User.by_id(int(uid))
+        self.user = uid and self.storage.get_user(int(uid))
 
     def write(self, *a, **kw):
         '''Write out string/HTML to browser
@@ -69,7 +91,7 @@ class BlogHandler(webapp2.RequestHandler):
     def render_str(self, template, **params):
         '''Set jinja2 template
 
-        Also insert user param on all requests
+        Also insert user and popular posts params on all requests
         
         Args:
             template: String template name
@@ -79,8 +101,8 @@ class BlogHandler(webapp2.RequestHandler):
             rendered page
         '''
         params["user"] = self.user
-        t = jinja_env.get_template(template)
-        return t.render(params)
+        params.setdefault("popular", counters.popular_posts())
+        return rendering.render_str(template, **params)
 
     def render(self, template, **params):
         ''' Primary method to render a template with params
@@ -177,7 +199,7 @@ class BlogFront(BlogHandler):
         Returns:
             rendered page
         '''
-        posts = greetings = data.Post.all().order("-created")
+        posts = self.storage.recent_posts()
         if self.user:
             self.render("blog.html", posts = posts,
                         username = self.user.username)
@@ -206,6 +228,7 @@ class PostPage(BlogHandler):
         Render full post page.
         Replaces newline characters in post content with HTML breaks.
         Pulls all comments that have the post as an ancestor to display
+        Counts a view in the write-behind view counters
         
         Args:
             None
@@ -213,24 +236,24 @@ class PostPage(BlogHandler):
         Returns:
             rendered full post page with all comments
         '''
-        post = data.Post.get_by_id(int(post_id), parent = data.blog_key())
+        post = self.storage.get_post(post_id)
         if not post:
             self.error(404)
             return
 
-        comments = data.Comment.all().ancestor(post).order("-created")
-        post._render_text = post.content.replace("\n", "<br>")  
-        self.render_post(post, comments)
+        counters.record_view(post_id)
+        self.render_post(post)
 
+    @ratelimit.limited("write")
     def post(self, post_id):
         '''Handles POST requests for full post page
 
         Handles the "action" from the valid user.
             like: add 1 to the post like count in DB. Not user's post
             dislike: subtract 1 from the post like count in DB. Not user's post
-            delete: deletes data.Post entity from DB, only for your own posts.
-            edit: edits data.Post entity in DB, only for your own posts.
-            add_comment: adds a Comment to DB for data.Post.  Any valid user
+            delete: deletes Post entity from DB, only for your own posts.
+            edit: edits Post entity in DB, only for your own posts.
+            add_comment: adds a Comment to DB for Post.  Any valid user
             edit_comment: edits a comment only by the author. Val is ID
             delete_comment: deletes a comment only by the author. Val is ID
         If not a user, cannot add/edit/delete comment or like post
@@ -241,76 +264,199 @@ class PostPage(BlogHandler):
         Returns:
             rendered page
         '''
-        post = data.Post.get_by_id(int(post_id), parent = data.blog_key())
+        post = self.storage.get_post(post_id)
         if not post:
             self.error(404)
             return
 
         if not self.user:
-            self.render_post(post, comments)
+            self.render_post(post)
             return
         
-        post._render_text = post.content.replace("\n", "<br>")
-        comments = data.Comment.all().ancestor(post).order("-created")
-        
+        uid = self.user.key().id()
         post_action = self.request.get("action")
         edit_comment = self.request.get("edit_comment")
         delete_comment = self.request.get("delete_comment")
         if post_action=="like":
-            post.add_like(self.user.key().id())
-            post.put()
-            self.render_post(post, comments)
+            post.add_like(uid)
+            self.storage.save_post(post)
+            changes.publish(post_id, post.version)
+            self.respond_post(post)
         elif post_action=="delete":
-            if data.User.by_id(post.user_id).username == self.user.username:
-                post.delete()
+            if post.user_id == uid:
+                self.storage.delete_post(post)
                 self.redirect("/blog")
         elif post_action=="edit":
-            if data.User.by_id(post.user_id).username == self.user.username:
+            if post.user_id == uid:
+                tags, error = parse_tags(self.request.get("tags"))
+                if error:
+                    self.render_post(post, error = error)
+                    return
                 post.title = self.request.get("title")
                 post.content = self.request.get("content")
-                post.put()
+                post.tags = tags
+                self.storage.save_post(post)
+                changes.publish(post_id, post.version)
                 self.redirect("/blog")
         elif post_action=="add_comment":
-            c = data.Comment(parent = post.key(), user_id=self.user.key().id(),
-                        content = self.request.get("comment_content"))
-            c.put()
-            self.render_post(post, comments)
+            self.storage.create_comment(
+                post, uid, self.request.get("comment_content"))
+            changes.publish(post_id, post.version)
+            self.respond_post(post)
         elif edit_comment:
             # Get specific comment edited based on the ID in btn value
-            comment = data.Comment.get_by_id(long(edit_comment),
-                                             parent = post.key())
+            comment = self.storage.get_comment(post, edit_comment)
             if not comment:
-                self.render_post(post, comments)
+                self.render_post(post)
                 return
-            if data.User.by_id(comment.user_id).username == self.user.username:
+            if comment.user_id == uid:
                 comment_content = self.request.get(str(comment.key().id()))
                 comment.content = comment_content
-                comment.put()
-                comments = data.Comment.all().ancestor(post).order("-created")
-                self.render_post(post, comments)
+                self.storage.save_comment(comment)
+                post.version = comment.version
+                changes.publish(post_id, post.version)
+                self.respond_post(post)
         elif delete_comment:
             # Get specific comment to delete based on the ID in btn value
-            comment = data.Comment.get_by_id(long(delete_comment),
-                                             parent = post.key())
+            comment = self.storage.get_comment(post, delete_comment)
             if not comment:
-                self.render_post(post, comments)
+                self.render_post(post)
                 return
-            if data.User.by_id(comment.user_id).username == self.user.username:
-                comment.delete()
-                comments = data.Comment.all().ancestor(post).order("-created")
-                self.render_post(post, comments)
+            if comment.user_id == uid:
+                post.version = self.storage.delete_comment(comment)
+                changes.publish(post_id, post.version)
+                self.respond_post(post)
+
+    def respond_post(self, post):
+        '''Answers a like or a comment change
+
+        Requests sent by newpost.js get a small JSON acknowledgement, since
+        the page picks up the change from the changes feed.  Plain form
+        posts get the full page as before.
+
+        Args:
+            post: Post entity that was changed
+
+        Returns:
+            rendered page or JSON
+        '''
+        if self.request.headers.get("X-Requested-With") == "XMLHttpRequest":
+            self.response.headers["Content-Type"] = "application/json"
+            self.write(json.dumps({"version": post.version}))
+        else:
+            self.render_post(post)
 
-    def render_post(self, post, comments):
+    def render_post(self, post, **params):
+        '''Renders the full post page with all comments, newest first
+
+        Replaces newline characters in post content with HTML breaks.
+        Comments are read after any change made by the request.
+
+        Args:
+            post: Post entity to render
+            params: extra name=value combos for the template, like error
+
+        Returns:
+            rendered page
+        '''
+        post._render_text = post.content.replace("\n", "<br>")
+        comments = self.storage.get_comments(post)
+        post_username = self.storage.get_user(post.user_id).username
         if self.user:
             self.render("permalink.html", post = post, comments = comments,
                         username = self.user.username,
-                        post_username=data.User.by_id(post.user_id).username)
+                        post_username=post_username, **params)
         else:
             self.render("permalink.html", post = post, comments = comments,
                         username = "Login", 
-                        post_username=data.User.by_id(post.user_id).username)
+                        post_username=post_username, **params)
 
         
+class PostChanges(BlogHandler):
+    '''Long-poll feed of comment and like changes for a full post page
+
+    inherits from BlogHandler
+    newpost.js polls this from permalink.html and applies the changes in
+    place, so readers see new comments and likes without reloading.
+    
+    Attributes:
+        None
+    
+    Methods:
+        get: waits for changes after a version and returns them as JSON
+    '''
+
+    def get(self, post_id):
+        '''Handles GET requests for /blog/<id>/changes?since=<version>
+
+        Waits up to changes.MAX_WAIT seconds, or the wait param, for the
+        post's change version to pass since.  Returns the new version, the
+        like count, rendered rows for comments added or edited after since
+        and the IDs of comments deleted after since.  If nothing changed,
+        returns only the current version.
+        When changes.MAX_WAITERS polls are already waiting, answers at once
+        with a Retry-After header instead of waiting.
+        
+        Args:
+            post_id: String post ID from the URL
+
+        Returns:
+            JSON {"version", "like_count", "comments": [{"id", "html"}],
+                  "deleted": [comment IDs]}
+        '''
+        try:
+            since = int(self.request.get("since"))
+            wait = min(float(self.request.get("wait", changes.MAX_WAIT)),
+                       changes.MAX_WAIT)
+        except ValueError:
+            self.error(400)
+            return
+        if not 0 <= since <= storage.MAX_ID:
+            self.error(400)
+            return
+
+        parked = wait > 0 and changes.waiters.acquire(False)
+        if wait > 0 and not parked:
+            self.response.headers["Retry-After"] = str(
+                changes.BUSY_RETRY_AFTER)
+        try:
+            version = changes.wait_for_change(self.storage, post_id, since,
+                                              wait if parked else 0)
+        finally:
+            if parked:
+                changes.waiters.release()
+        if version is None:
+            self.error(404)
+            return
+
+        result = {"version": version}
+        if version > since:
+            post = self.storage.get_post(post_id)
+            if not post:
+                self.error(404)
+                return
+            limit = changes.MAX_COMMENTS
+            comments = self.storage.changed_comments(post, since, limit)
+            deleted = self.storage.deleted_comments(post, since, limit)
+            result = {"version": post.version,
+                      "like_count": post.like_count(),
+                      "comments": [{"id": c.key().id(),
+                                    "html": self.render_str("comment.html",
+                                                            c = c)}
+                                   for c in comments],
+                      "deleted": [cid for cid, v in deleted]}
+            # When more changes remain, resume after the shorter batch
+            if len(comments) == limit:
+                result["version"] = min(result["version"],
+                                        comments[-1].version)
+            if len(deleted) == limit:
+                result["version"] = min(result["version"], deleted[-1][1])
+
+        self.response.headers["Content-Type"] = "application/json"
+        self.response.headers["Cache-Control"] = "no-cache"
+        self.write(json.dumps(result))
+
+
 class NewPost(BlogHandler):
     '''Handles the new post page of the blog
 
@@ -364,17 +510,100 @@ class NewPost(BlogHandler):
         
         title = self.request.get("title")
         content = self.request.get("content")
+        raw_tags = self.request.get("tags")
+        tags, error = parse_tags(raw_tags)
 
-        if title and content:
-            p = data.Post(parent = data.blog_key(), title = title, content = content,
-                     likes=[self.user.key().id()],
-                     user_id=self.user.key().id())
-            p.put()
+        if title and content and not error:
+            p = self.storage.create_post(title, content, self.user.key().id(),
+                                         tags)
             self.redirect("/blog/%s" % str(p.key().id()))
         else:
-            error = "Enter a title and content, please!"
+            error = error or "Enter a title and content, please!"
             self.render("newpost.html", title=title, content=content,
-                        error=error)
+                        tags=raw_tags, error=error)
+
+
+class ListingPage(BlogHandler):
+    '''Base for the tag, author and month listing pages
+
+    inherits from BlogHandler
+    Each listing is one bounded, cursor paged indexed query.
+    
+    Attributes:
+        None
+    
+    Methods:
+        render_listing: renders a page of posts with a heading and count
+    '''
+
+    def render_listing(self, heading, page, count = None):
+        '''Renders one page of a listing
+
+        Args:
+            heading: String heading for the listing
+            page: function(limit, cursor) returning (posts, next cursor)
+            count: Int precomputed post count, or None to not show one
+
+        Returns:
+            rendered page
+        '''
+        try:
+            posts, next_cursor = page(LISTING_PAGE_SIZE,
+                                      self.request.get("cursor") or None)
+        except storage.InvalidCursorError:
+            self.error(400)
+            return
+        if self.user:
+            username = self.user.username
+        else:
+            username = "Login"
+        self.render("listing.html", heading = heading, count = count,
+                    posts = posts, next_cursor = next_cursor,
+                    username = username)
+
+
+class TagPage(ListingPage):
+    '''Lists posts with a tag at /blog/tag/<tag>, newest first'''
+
+    def get(self, tag):
+        count = self.storage.archive_counts(["tag:%s" % tag])["tag:%s" % tag]
+        self.render_listing(
+            "Posts tagged %s" % tag,
+            lambda limit, cursor: self.storage.posts_by_tag(tag, limit,
+                                                            cursor),
+            count)
+
+
+class AuthorPage(ListingPage):
+    '''Lists a user's posts at /blog/author/<username>, newest first'''
+
+    def get(self, name):
+        author = self.storage.user_by_name(name)
+        if not author:
+            self.error(404)
+            return
+        self.render_listing(
+            "Posts by %s" % author.username,
+            lambda limit, cursor: self.storage.posts_by_author(
+                author.key().id(), limit, cursor))
+
+
+class MonthArchive(ListingPage):
+    '''Lists a month's posts at /blog/<yyyy>/<mm>, newest first'''
+
+    def get(self, year, month):
+        try:
+            start, end = storage.month_range(year, month)
+            heading = "Posts from %s" % start.strftime("%B %Y")
+        except ValueError:
+            self.error(404)
+            return
+        name = "month:%s-%s" % (year, month)
+        self.render_listing(
+            heading,
+            lambda limit, cursor: self.storage.posts_by_month(
+                year, month, limit, cursor),
+            self.storage.archive_counts([name])[name])
 
 
 class Signup(BlogHandler):
@@ -407,6 +636,7 @@ class Signup(BlogHandler):
         else:
             self.render("signup.html")
 
+    @ratelimit.limited("auth")
     def post(self):
         '''Handles POST requests for registration
 
@@ -435,7 +665,7 @@ class Signup(BlogHandler):
                       pwd1 = self.pwd1,
                       pwd2 = self.pwd2)
 
-        u = data.User.by_name(self.username)
+        u = self.storage.user_by_name(self.username)
         
         if u:
             params["error"] = "data.Username already exists!"
@@ -450,8 +680,8 @@ class Signup(BlogHandler):
             self.render("signup.html", **params)
         elif (self.username and self.pwd1 and self.pwd2
               and (self.pwd1 == self.pwd2)):           
-            u = data.User.register(self.username, self.pwd1, self.email)
-            u.put()
+            u = self.storage.register_user(self.username, self.pwd1,
+                                           self.email)
             self.login(u)
             self.redirect("/blog")
         elif self.pwd1 != self.pwd2:
@@ -488,6 +718,7 @@ class Login(BlogHandler):
         '''
         self.render("login.html")
 
+    @ratelimit.limited("auth")
     def post(self):
         '''Handles POST requests for login form
 
@@ -503,7 +734,7 @@ class Login(BlogHandler):
         username = self.request.get("username")
         pwd = self.request.get("pwd")
 
-        u = data.User.login(username, pwd)
+        u = self.storage.login(username, pwd)
         if u:
             self.login(u)
             self.redirect("/blog")
@@ -540,12 +771,140 @@ class Logout(BlogHandler):
         self.redirect("/blog")
 
 
+class Warmup(webapp2.RequestHandler):
+    '''Handles App Engine warmup requests for new instances
+
+    Runs before a new instance takes user traffic so the first real request
+    does not pay for template compilation, the first storage round trips or
+    the first leaderboard read from the cache.
+
+    Methods:
+        get: compiles templates, opens storage and primes the leaderboard
+    '''
+
+    def get(self):
+        '''Handles GET requests to /_ah/warmup
+
+        Compiles every template, creates the storage backend, loads the
+        newest posts with their authors to open its connections, and keeps
+        the popular posts leaderboard in process for the first page render.
+
+        Args:
+            None
+
+        Returns:
+            None
+        '''
+        templates = rendering.precompile()
+        posts = storage.get_backend().warmup()
+        popular = counters.popular_posts()
+        logging.info("warmup: compiled %d templates, loaded %d posts, "
+                     "%d popular posts", len(templates), len(posts),
+                     len(popular))
+        self.response.headers["Content-Type"] = "text/plain"
+        self.response.out.write("OK")
+
+
+class TaskHandler(webapp2.RequestHandler):
+    '''Base for /tasks/ handlers, run only by cron, the task queue or admins
+
+    app.yaml already limits /tasks/ to admins, but the handlers check again
+    so the tasks stay closed wherever main.app is served.  The cron and
+    task queue headers are only trusted on App Engine, which strips them
+    from outside requests.  Elsewhere every request is refused, and
+    serve.py runs the tasks itself.
+
+    Methods:
+        dispatch: answers 403 unless is_authorized()
+        is_authorized: True for cron, task queue and admin requests
+    '''
+
+    def dispatch(self):
+        if not self.is_authorized():
+            logging.warning("Refused %s from %s", self.request.path,
+                            self.request.remote_addr)
+            self.abort(403)
+        webapp2.RequestHandler.dispatch(self)
+
+    def is_authorized(self):
+        if not users:
+            return False
+        headers = self.request.headers
+        return (headers.get("X-Appengine-Cron") == "true" or
+                "X-Appengine-QueueName" in headers or
+                users.is_current_user_admin())
+
+
+class RefreshPopular(TaskHandler):
+    '''Handles the scheduled popular posts refresh.  See cron.yaml
+
+    Methods:
+        get: flushes buffered views and rebuilds the leaderboard
+    '''
+
+    def get(self):
+        '''Handles GET requests to /tasks/refresh_popular
+
+        Cron or admin only.  Flushes this instance's buffered views,
+        then recomputes and caches the popular posts.
+
+        Args:
+            None
+
+        Returns:
+            None
+        '''
+        flushed = counters.flush_views()
+        board = counters.refresh_leaderboard()
+        logging.info("refresh_popular: flushed %d posts, %d on leaderboard",
+                     flushed, len(board))
+        self.response.headers["Content-Type"] = "text/plain"
+        self.response.out.write("OK")
+
+
+class RebuildArchives(TaskHandler):
+    '''Handles recounting all tag and month archives
+
+    Methods:
+        get: starts rebuilding the precomputed archive counts
+    '''
+
+    def get(self):
+        '''Handles GET requests to /tasks/rebuild_archives
+
+        Admin only.  Run once for posts written before archive counts
+        existed, or to repair drifted counts.  On the datastore the recount
+        runs in deferred tasks after this request returns.
+
+        Args:
+            None
+
+        Returns:
+            None
+        '''
+        totals = storage.get_backend().rebuild_archive_counts(
+            background = True)
+        if totals is None:
+            logging.info("rebuild_archives: started")
+        else:
+            logging.info("rebuild_archives: %d archives", len(totals))
+        self.response.headers["Content-Type"] = "text/plain"
+        self.response.out.write("OK")
+
 
 app = webapp2.WSGIApplication([("/", BlogFront),
                                ("/blog/?", BlogFront),
                                ("/blog/([0-9]+)", PostPage),
+                               ("/blog/([0-9]+)/changes", PostChanges),
                                ("/blog/newpost", NewPost),
+                               ("/blog/tag/([a-z0-9-]+)", TagPage),
+                               ("/blog/author/([A-Za-z]+)", AuthorPage),
+                               ("/blog/([0-9]{4})/([0-9]{2})", MonthArchive),
                                ("/blog/signup", Signup),
                                ("/blog/login", Login),
-                               ("/blog/logout", Logout)],
+                               ("/blog/logout", Logout),
+                               ("/_ah/warmup", Warmup),
+                               ("/tasks/refresh_popular", RefreshPopular),
+                               ("/tasks/rebuild_archives", RebuildArchives)]
+                              + api.routes,
                               debug=True)
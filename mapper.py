@@ -0,0 +1,272 @@
+'''Resumable batch mapper for rewriting every entity of a datastore kind.
+
+A Mapper walks a kind with query cursors in fixed size batches, passes each
+entity to a mapping function and writes whatever it returns with one
+batched db.put per batch.  After every batch the cursor and counters are
+checkpointed in a MapperState entity, so a run stopped by a crash or a
+request deadline picks up where it left off.
+
+    def dedupe_likes(post):
+        if len(set(post.likes)) != len(post.likes):
+            post.likes = sorted(set(post.likes))
+            return post
+
+    m = mapper.Mapper("dedupe_likes", data.Post, dedupe_likes,
+                      batch_size = 200, max_per_second = 500)
+    m.run(deadline = 50)     # in a request, or
+    m.start()                # in chained task queue tasks until done
+
+Batches are written before their checkpoint, so after a crash the last
+batch may be mapped twice.  Mapping functions must be idempotent.
+
+Each checkpoint carries a run_id, kept when a run resumes and new after
+reset().  A run only checkpoints while the stored run_id is still its own,
+so a chain of tasks left over from before a reset() stops at its next
+batch instead of moving the new run's cursor.
+Subclasses can override finish() to act once every entity was mapped, as
+archives.ArchiveRecount does to total up its per batch counts.
+'''
+
+import collections
+import logging
+import time
+import uuid
+
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+# Seconds a task spends mapping before it checkpoints and chains the next
+TASK_DEADLINE = 8 * 60
+
+BatchProgress = collections.namedtuple(
+    "BatchProgress",
+    "job batch read written total_read total_written seconds rate done")
+
+
+class MapperState(db.Model):
+    '''Checkpoint for a mapper job.  key_name is the job name
+
+    Attributes:
+        kind: String kind being mapped
+        cursor: Text query cursor after the last finished batch
+        batches: Int number of batches finished
+        read: Int number of entities passed to the mapping function
+        written: Int number of entities written
+        done: Boolean True once the whole kind has been mapped
+        run_id: String ID of the run the checkpoint belongs to
+        created: DateTime of when the job first ran
+        last_modified: DateTime of the last checkpoint
+    '''
+
+    kind = db.StringProperty(required = True)
+    cursor = db.TextProperty()
+    batches = db.IntegerProperty(default = 0)
+    read = db.IntegerProperty(default = 0)
+    written = db.IntegerProperty(default = 0)
+    done = db.BooleanProperty(default = False)
+    run_id = db.StringProperty()
+    created = db.DateTimeProperty(auto_now_add = True)
+    last_modified = db.DateTimeProperty(auto_now = True)
+
+
+class Mapper(object):
+    '''Maps a function over every entity of a kind in resumable batches
+
+    Attributes:
+        name: String job name.  Runs with the same name share a checkpoint
+        model: db.Model subclass to walk.  data.Post, data.Comment, ...
+        map_fn: function taking an entity and returning an entity or list
+            of entities to write, or None to leave it unchanged
+        batch_size: Int entities fetched and written per batch
+        max_per_second: Int limit on entities read per second, or None
+        dry_run: Boolean.  If True map but never write or checkpoint
+        on_batch: optional function called with a BatchProgress per batch
+        run_id: String run_id of the checkpoint this mapper works on, set by
+            the first run() or start()
+
+    Methods:
+        query: returns the query to walk, override to filter
+        load_state: returns the MapperState checkpoint for the job
+        run: maps batches until the kind is done or a deadline passes
+        start: runs the job in chained task queue tasks
+        reset: deletes the checkpoint so the next run starts over
+        finish: called when a run finds the whole kind mapped
+    '''
+
+    def __init__(self, name, model, map_fn, batch_size = 100,
+                 max_per_second = None, dry_run = False, on_batch = None):
+        self.name = name
+        self.model = model
+        self.map_fn = map_fn
+        self.batch_size = batch_size
+        self.max_per_second = max_per_second
+        self.dry_run = dry_run
+        self.on_batch = on_batch
+        self.run_id = None
+
+    def query(self):
+        return self.model.all()
+
+    def load_state(self):
+        '''Returns the checkpoint for this job
+
+        Dry runs get a fresh unsaved state so they never move the cursor
+        of the real job.  A new checkpoint gets a new run_id.
+
+        Args:
+            None
+
+        Returns:
+            MapperState entity
+        '''
+        kind = self.model.kind()
+        run_id = uuid.uuid4().hex
+        if self.dry_run:
+            return MapperState(key_name = self.name, kind = kind,
+                               run_id = run_id)
+        return MapperState.get_or_insert(self.name, kind = kind,
+                                         run_id = run_id)
+
+    def reset(self):
+        db.delete(db.Key.from_path("MapperState", self.name))
+        self.run_id = None
+
+    def _checkpoint(self, state):
+        '''Saves state unless another run took over the checkpoint
+
+        Returns:
+            Boolean True if saved
+        '''
+        def txn():
+            stored = MapperState.get_by_key_name(self.name)
+            if stored is None or stored.run_id != state.run_id:
+                return False
+            state.put()
+            return True
+        return db.run_in_transaction(txn)
+
+    def _superseded(self, state):
+        logging.info("mapper %s: run %s was superseded by %s, stopping",
+                     self.name, self.run_id, state.run_id)
+
+    def finish(self):
+        '''Called by run() once the whole kind has been mapped
+
+        Runs again on every later run() of a finished job, and again if it
+        raised, so overrides must be idempotent.  Never called on dry runs.
+
+        Args:
+            None
+
+        Returns:
+            None
+        '''
+        pass
+
+    def _map_batch(self, entities):
+        to_put = []
+        for entity in entities:
+            out = self.map_fn(entity)
+            if out is None:
+                continue
+            if isinstance(out, (list, tuple)):
+                to_put.extend(out)
+            else:
+                to_put.append(out)
+        return to_put
+
+    def run(self, deadline = None, state = None):
+        '''Maps batches until the kind is done or deadline seconds pass
+
+        Args:
+            deadline: Int seconds to run before returning, or None
+            state: MapperState to continue from instead of the checkpoint.
+                start() passes the unsaved state of a dry run to each task
+
+        Returns:
+            MapperState with the checkpointed progress.  Its run_id differs
+            from the mapper's if another run took over the checkpoint
+        '''
+        if state is None:
+            state = self.load_state()
+        if self.run_id is None or self.dry_run:
+            self.run_id = state.run_id
+        elif state.run_id != self.run_id:
+            self._superseded(state)
+            return state
+        started = time.time()
+        read_this_run = 0
+        while not state.done:
+            batch_start = time.time()
+            q = self.query()
+            if state.cursor:
+                q.with_cursor(state.cursor)
+            entities = q.fetch(self.batch_size)
+            to_put = self._map_batch(entities)
+            if to_put and not self.dry_run:
+                db.put(to_put)
+
+            state.cursor = q.cursor()
+            state.batches += 1
+            state.read += len(entities)
+            state.written += len(to_put)
+            state.done = len(entities) < self.batch_size
+            if not self.dry_run and not self._checkpoint(state):
+                state = self.load_state()
+                self._superseded(state)
+                return state
+            read_this_run += len(entities)
+            self._report(state, len(entities), len(to_put),
+                         time.time() - batch_start)
+
+            if self.max_per_second:
+                # Sleep off any lead over the allowed rate
+                ahead = (float(read_this_run) / self.max_per_second
+                         - (time.time() - started))
+                if ahead > 0 and not state.done:
+                    time.sleep(ahead)
+            if deadline is not None and time.time() - started >= deadline:
+                break
+        if state.done and not self.dry_run:
+            self.finish()
+        return state
+
+    def _report(self, state, read, written, seconds):
+        progress = BatchProgress(
+            job = self.name, batch = state.batches, read = read,
+            written = written, total_read = state.read,
+            total_written = state.written, seconds = seconds,
+            rate = read / seconds if seconds else 0.0, done = state.done)
+        logging.info("mapper %s%s batch %d: read %d wrote %d in %.2fs "
+                     "(%.0f/s), total read %d wrote %d%s",
+                     self.name, " [dry run]" if self.dry_run else "",
+                     progress.batch, read, written, seconds, progress.rate,
+                     state.read, state.written, " done" if state.done else "")
+        if self.on_batch:
+            self.on_batch(progress)
+
+    def start(self, deadline = TASK_DEADLINE, **task_args):
+        '''Runs the job in chained deferred tasks until it is done
+
+        The mapper is pickled into each task, so map_fn, the model and
+        on_batch must be module level names.  Dry runs have no checkpoint,
+        so their progress is pickled into the next task instead.  Tasks
+        stop once reset() gives the job a new run.
+
+        Args:
+            deadline: Int seconds each task runs before chaining the next
+            task_args: passed to deferred.defer.  _queue, _countdown, ...
+
+        Returns:
+            None
+        '''
+        if not self.dry_run and self.run_id is None:
+            self.run_id = self.load_state().run_id
+        deferred.defer(_run_task, self, deadline, task_args, **task_args)
+
+
+def _run_task(mapper, deadline, task_args, state = None):
+    state = mapper.run(deadline, state)
+    if not state.done and state.run_id == mapper.run_id:
+        deferred.defer(_run_task, mapper, deadline, task_args,
+                       state if mapper.dry_run else None, **task_args)
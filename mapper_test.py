@@ -0,0 +1,81 @@
+import pytest
+
+# mapper and data need the App Engine SDK even to import
+pytest.importorskip("google.appengine.ext.db")
+
+import data
+import mapper
+
+
+def dedupe_likes(post):
+    if len(set(post.likes)) != len(post.likes):
+        post.likes = sorted(set(post.likes))
+        return post
+
+
+def make_posts(n):
+    for i in range(n):
+        data.Post(parent = data.blog_key(), title = "t%d" % i,
+                  content = "c", user_id = 1, likes = [1, 1, 2]).put()
+
+
+def test_mapper_resumes_from_checkpoint(datastore):
+    make_posts(5)
+    m = mapper.Mapper("dedupe", data.Post, dedupe_likes, batch_size = 2)
+
+    state = m.run(deadline = 0)
+    assert (state.batches, state.read, state.done) == (1, 2, False)
+
+    state = m.run()
+    assert (state.read, state.written, state.done) == (5, 5, True)
+    assert all(p.likes == [1, 2] for p in data.Post.all())
+
+
+def test_mapper_dry_run_writes_nothing(datastore):
+    make_posts(3)
+    progress = []
+    m = mapper.Mapper("dedupe", data.Post, dedupe_likes, batch_size = 2,
+                      dry_run = True, on_batch = progress.append)
+
+    state = m.run()
+    assert state.done and state.written == 3
+    assert [p.read for p in progress] == [2, 1]
+    assert all(p.likes == [1, 1, 2] for p in data.Post.all())
+    assert mapper.MapperState.get_by_key_name("dedupe") is None
+
+
+def test_mapper_dry_run_tasks_carry_progress(datastore, monkeypatch):
+    make_posts(5)
+    tasks = []
+    monkeypatch.setattr(mapper.deferred, "defer",
+                        lambda *args, **kw: tasks.append(args))
+    progress = []
+    m = mapper.Mapper("dedupe", data.Post, dedupe_likes, batch_size = 2,
+                      dry_run = True, on_batch = progress.append)
+
+    m.start(deadline = 0)
+    while tasks:
+        args = tasks.pop(0)
+        args[0](*args[1:])
+    assert [p.total_read for p in progress] == [2, 4, 5]
+    assert mapper.MapperState.get_by_key_name("dedupe") is None
+
+
+def test_reset_stops_tasks_of_the_old_run(datastore, monkeypatch):
+    make_posts(5)
+    tasks = []
+    monkeypatch.setattr(mapper.deferred, "defer",
+                        lambda *args, **kw: tasks.append(args))
+    old = mapper.Mapper("dedupe", data.Post, dedupe_likes, batch_size = 2)
+    old.start(deadline = 0)
+    args = tasks.pop()
+    args[0](*args[1:])
+    old_task = tasks.pop()
+
+    new = mapper.Mapper("dedupe", data.Post, dedupe_likes, batch_size = 2)
+    new.reset()
+    assert new.run(deadline = 0).read == 2
+    old_task[0](*old_task[1:])
+    assert not tasks
+    state = mapper.MapperState.get_by_key_name("dedupe")
+    assert (state.run_id, state.read) == (new.run_id, 2)
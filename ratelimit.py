@@ -0,0 +1,201 @@
+'''Admission control and token bucket rate limits for expensive endpoints.
+
+Login and signup hash passwords, and post actions write and re-render the
+whole post, so each endpoint class gets its own token buckets, one per
+client IP and one per signed in user.  A request takes a token from each of
+its buckets, or from none of them if any is empty.  Buckets live in
+memcache so all App Engine instances see the same limits.  If the cache is
+down or too contended to update, the buckets are kept in this process
+instead.
+
+Without App Engine (serve.py) there is no memcache, so every process keeps
+its own buckets: with --workers N a client can get up to N times the
+LIMITS rates, depending on which workers accept its connections.
+
+On top of the buckets, each process admits at most MAX_IN_FLIGHT limited
+requests at a time and sheds the rest, so a burst of writes never takes
+every thread away from page reads.
+
+Decorate a handler method with limited() to apply both.  Rejected requests
+get 429 (over a limit) or 503 (shed), each with a Retry-After header, and
+are counted per endpoint; see rejection_counts().
+'''
+
+import collections
+import functools
+import logging
+import math
+import threading
+import time
+
+import cache
+
+Limit = collections.namedtuple("Limit", ["rate", "burst"])
+
+# Tokens per second and bucket size for each endpoint class
+LIMITS = {
+    "auth": Limit(rate = 5 / 60.0, burst = 10),
+    "write": Limit(rate = 1.0, burst = 20),
+}
+
+MAX_IN_FLIGHT = 4
+# Seconds a shed client is asked to wait
+SHED_RETRY_AFTER = 1
+CAS_RETRIES = 3
+
+BUCKET_KEY = "ratelimit:%s:%s"
+REJECTED_KEY = "ratelimit:rejected:%s"
+
+# Buckets used when the shared cache cannot be updated
+fallback = cache.LocalCache()
+in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+
+
+def _now():
+    return time.time()
+
+
+def _refill(state, limit, now):
+    '''Returns the tokens in a bucket at now'''
+    if state is None:
+        return float(limit.burst)
+    tokens, updated = state
+    return min(float(limit.burst),
+               tokens + max(0, now - updated) * limit.rate)
+
+
+def _take(client, keys, limit, now):
+    '''Takes one token from every bucket with compare-and-set
+
+    All buckets are checked before any is written, so a request refused by
+    one bucket never drains the others.  Only a request racing for the
+    same bucket between the check and the write can still drain one.
+
+    Args:
+        client: cache with gets, add and cas
+        keys: list of String cache keys of the buckets
+        limit: Limit for the buckets
+        now: Float current time
+
+    Returns:
+        Int seconds until every bucket has a token, 0 if the tokens were
+        taken, or None if the buckets could not be updated
+    '''
+    ttl = int(math.ceil(limit.burst / limit.rate)) + 1
+    pending = list(keys)
+    for i in xrange(CAS_RETRIES):
+        states = [client.gets(key) for key in pending]
+        tokens = [_refill(state, limit, now) for state in states]
+        if min(tokens) < 1:
+            return int(math.ceil((1 - min(tokens)) / limit.rate))
+        for key, state, n in zip(list(pending), states, tokens):
+            if state is None:
+                stored = client.add(key, (n - 1, now), time = ttl)
+            else:
+                stored = client.cas(key, (n - 1, now), time = ttl)
+            if not stored:
+                break
+            pending.remove(key)
+        if not pending:
+            return 0
+    return None
+
+
+def check(endpoint_class, ip, user_id = None):
+    '''Takes a token from the IP bucket and the user's bucket
+
+    Admits the request if the buckets could not be updated even in process.
+
+    Args:
+        endpoint_class: String key of LIMITS
+        ip: String client IP address
+        user_id: Int ID of the signed in user, or None
+
+    Returns:
+        Int seconds the client should wait, or 0 if the request may run
+    '''
+    limit = LIMITS[endpoint_class]
+    now = _now()
+    keys = [BUCKET_KEY % (endpoint_class, "ip:%s" % ip)]
+    if user_id:
+        keys.append(BUCKET_KEY % (endpoint_class, "user:%d" % user_id))
+    try:
+        wait = _take(cache.cas_client(), keys, limit, now)
+    except Exception:
+        logging.exception("Rate limit cache unavailable")
+        wait = None
+    if wait is None:
+        wait = _take(fallback, keys, limit, now)
+    return wait or 0
+
+
+def count_rejection(endpoint):
+    '''Counts one rejected request for an endpoint'''
+    if cache.client().incr(REJECTED_KEY % endpoint, initial_value = 0) is None:
+        logging.warning("Could not count rejection for %s", endpoint)
+
+
+def rejection_counts(endpoints):
+    '''Returns how many requests each endpoint rejected
+
+    Counts live in the shared cache, so they start over when it is flushed.
+
+    Args:
+        endpoints: list of String endpoint names, the handler class names
+
+    Returns:
+        dict of String endpoint to Int rejected requests
+    '''
+    client = cache.client()
+    return dict((e, client.get(REJECTED_KEY % e) or 0) for e in endpoints)
+
+
+def reject(handler, status, message, retry_after):
+    '''Writes a plain text rejection and counts it
+
+    Args:
+        handler: webapp2.RequestHandler being rejected
+        status: Int HTTP status, 429 or 503
+        message: String status message
+        retry_after: Int seconds for the Retry-After header
+
+    Returns:
+        None
+    '''
+    endpoint = type(handler).__name__
+    count_rejection(endpoint)
+    logging.info("Rejected %s from %s: %d", endpoint,
+                 handler.request.remote_addr, status)
+    handler.response.set_status(status, message)
+    handler.response.headers["Retry-After"] = str(retry_after)
+    handler.response.headers["Content-Type"] = "text/plain"
+    handler.response.out.write("%s, try again in %d seconds"
+                               % (message, retry_after))
+
+
+def limited(endpoint_class):
+    '''Decorates a BlogHandler method with rate limits and admission control
+
+    Args:
+        endpoint_class: String key of LIMITS the endpoint belongs to
+
+    Returns:
+        decorator for handler methods
+    '''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(handler, *a, **kw):
+            user_id = handler.user and handler.user.key().id()
+            wait = check(endpoint_class, handler.request.remote_addr, user_id)
+            if wait:
+                reject(handler, 429, "Too Many Requests", wait)
+                return
+            if not in_flight.acquire(False):
+                reject(handler, 503, "Service Unavailable", SHED_RETRY_AFTER)
+                return
+            try:
+                return method(handler, *a, **kw)
+            finally:
+                in_flight.release()
+        return wrapper
+    return decorator
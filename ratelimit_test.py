@@ -0,0 +1,91 @@
+import threading
+
+import pytest
+
+import cache
+import ratelimit
+
+
+@pytest.fixture(autouse = True)
+def clock(backend, monkeypatch):
+    ratelimit.fallback.flush_all()
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit, "_now", lambda: now[0])
+    monkeypatch.setattr(ratelimit, "in_flight", threading.BoundedSemaphore(
+        ratelimit.MAX_IN_FLIGHT))
+    return now
+
+
+@pytest.fixture
+def app(app):
+    app.extra_environ["REMOTE_ADDR"] = "10.0.0.1"
+    return app
+
+
+def test_bucket_refills_over_time(clock):
+    limit = ratelimit.LIMITS["auth"]
+    for i in range(limit.burst):
+        assert ratelimit.check("auth", "10.0.0.2") == 0
+    assert ratelimit.check("auth", "10.0.0.2") == 12
+    assert ratelimit.check("auth", "10.0.0.3") == 0
+
+    clock[0] += 12
+    assert ratelimit.check("auth", "10.0.0.2") == 0
+    assert ratelimit.check("auth", "10.0.0.2") > 0
+
+
+def test_user_bucket_spans_ips():
+    for i in range(ratelimit.LIMITS["write"].burst):
+        assert ratelimit.check("write", "10.0.1.%d" % i, user_id = 7) == 0
+    assert ratelimit.check("write", "10.0.2.1", user_id = 7) == 1
+    assert ratelimit.check("write", "10.0.2.1", user_id = 8) == 0
+
+
+def test_refused_requests_take_no_tokens():
+    burst = ratelimit.LIMITS["write"].burst
+    for i in range(burst):
+        assert ratelimit.check("write", "10.0.1.%d" % i, user_id = 7) == 0
+    # The user's bucket is empty, so the IP bucket must stay full
+    for i in range(burst + 5):
+        assert ratelimit.check("write", "10.0.2.1", user_id = 7) == 1
+    for i in range(burst):
+        assert ratelimit.check("write", "10.0.2.1") == 0
+
+
+def test_lost_cas_race_retries(clock):
+    key = ratelimit.BUCKET_KEY % ("auth", "ip:x")
+    cache.local.set(key, (5.0, clock[0]))
+    real_gets = cache.local.gets
+
+    def racing_gets(k):
+        value = real_gets(k)
+        if k == key and len(calls) < 2:
+            calls.append(k)
+            cache.local.set(k, (4.0, clock[0]))
+        return value
+    calls = []
+    cache.local.gets = racing_gets
+    try:
+        assert ratelimit._take(cache.local, [key], ratelimit.LIMITS["auth"],
+                               clock[0]) == 0
+    finally:
+        del cache.local.gets
+    assert cache.local.get(key) == (3.0, clock[0])
+
+
+def test_login_answers_429_and_counts(app):
+    for i in range(ratelimit.LIMITS["auth"].burst):
+        app.post("/blog/login", {"username": "bob", "pwd": "x"})
+    response = app.post("/blog/login", {"username": "bob", "pwd": "x"},
+                        status = 429)
+    assert response.headers["Retry-After"] == "12"
+    assert ratelimit.rejection_counts(["Login", "Signup"]) == {
+        "Login": 1, "Signup": 0}
+
+
+def test_sheds_load_when_busy(app):
+    ratelimit.in_flight = threading.BoundedSemaphore(1)
+    ratelimit.in_flight.acquire()
+    response = app.post("/blog/signup", {"username": "bob"}, status = 503)
+    assert response.headers["Retry-After"] == "1"
+    assert ratelimit.rejection_counts(["Signup"]) == {"Signup": 1}
@@ -0,0 +1,65 @@
+'''Jinja2 template rendering shared by handlers and models.
+
+Lives outside main.py so data.py and the storage backends can render
+templates without importing main.  The jinja2 environment is created on
+first use, and precompile() lets the warmup request pay for loading and
+compiling every template before real traffic arrives.
+'''
+
+import os
+import threading
+
+template_dir = os.path.join(os.path.dirname(__file__), "templates")
+
+_env = None
+_env_lock = threading.Lock()
+
+
+def jinja_env():
+    '''Returns the shared jinja2 Environment, creating it on first use
+
+    Args:
+        None
+
+    Returns:
+        jinja2.Environment for the templates folder
+    '''
+    global _env
+    if _env is None:
+        with _env_lock:
+            if _env is None:
+                import jinja2
+                _env = jinja2.Environment(
+                    loader = jinja2.FileSystemLoader(template_dir),
+                    autoescape = True, cache_size = -1)
+    return _env
+
+
+def render_str(template, **params):
+    '''Renders a jinja2 template with params to a string.
+
+    Args:
+        template: String template name within the templates folder.  HTML
+        params: name=value combos to send to the template
+
+    Returns:
+        rendered page
+    '''
+    t = jinja_env().get_template(template)
+    return t.render(params)
+
+
+def precompile():
+    '''Loads and compiles every template into the environment cache
+
+    Args:
+        None
+
+    Returns:
+        list of String template names that were compiled
+    '''
+    env = jinja_env()
+    names = env.list_templates(extensions = ["html"])
+    for name in names:
+        env.get_template(name)
+    return names
@@ -0,0 +1,238 @@
+'''Standalone WSGI server for running the blog without App Engine.
+
+Serves main.app plus the static directories from app.yaml using a fixed
+pool of threads per process, optionally pre-forking several worker
+processes that share one listening socket.  Storage defaults to SQLite.
+
+    $ python serve.py --port 8080 --threads 16 --workers 4 --db blog.db
+'''
+
+import argparse
+import logging
+import mimetypes
+import os
+import signal
+import sys
+import threading
+import time
+import Queue
+from wsgiref import simple_server
+
+os.environ.setdefault("BLOG_STORAGE", "sqlite")
+
+import changes
+import counters
+import main
+import storage
+
+STATIC_DIRS = {"/css/": "css", "/js/": "js", "/fonts/": "fonts"}
+# Admin only in app.yaml.  serve.py runs the scheduled tasks itself
+BLOCKED_PREFIXES = ("/tasks/",)
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def static_app(app, root = ROOT, dirs = STATIC_DIRS,
+               blocked = BLOCKED_PREFIXES):
+    '''Wraps a WSGI app to serve static files like the app.yaml handlers
+
+    Args:
+        app: WSGI application for all other paths
+        root: String directory the static dirs are relative to
+        dirs: dict of URL prefix to directory name
+        blocked: list of URL prefixes answered with 403 Forbidden
+
+    Returns:
+        WSGI application
+    '''
+    def wrapped(environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        if path.startswith(tuple(blocked)):
+            start_response("403 Forbidden", [("Content-Type", "text/plain")])
+            return ["Forbidden"]
+        for prefix, folder in dirs.items():
+            if not path.startswith(prefix):
+                continue
+            base = os.path.join(root, folder)
+            full = os.path.normpath(os.path.join(base, path[len(prefix):]))
+            if not full.startswith(base + os.sep) or not os.path.isfile(full):
+                start_response("404 Not Found",
+                               [("Content-Type", "text/plain")])
+                return ["Not Found"]
+            ctype = mimetypes.guess_type(full)[0] or "application/octet-stream"
+            with open(full, "rb") as f:
+                body = f.read()
+            start_response("200 OK", [("Content-Type", ctype),
+                                      ("Content-Length", str(len(body))),
+                                      ("Cache-Control", "public, max-age=600")])
+            return [body]
+        return app(environ, start_response)
+    return wrapped
+
+
+class QuietHandler(simple_server.WSGIRequestHandler):
+    '''Request handler that skips per-request logging to stderr'''
+
+    def log_request(self, *args, **kw):
+        pass
+
+
+class ThreadPoolWSGIServer(simple_server.WSGIServer):
+    '''WSGI server handling requests on a fixed pool of threads
+
+    Unlike SocketServer.ThreadingMixIn it never starts more than threads
+    threads, so a burst of connections queues instead of exhausting memory.
+
+    Attributes:
+        threads: Int number of worker threads
+        tasks: list of (Int seconds, function) run periodically in each
+            process, standing in for App Engine cron
+    '''
+
+    request_queue_size = 128
+
+    def __init__(self, address, handler, threads = 8, bind = True,
+                 tasks = ()):
+        simple_server.WSGIServer.__init__(self, address, handler,
+                                          bind_and_activate = bind)
+        self.threads = threads
+        self.tasks = tasks
+        self._requests = Queue.Queue(threads * 4)
+
+    def serve_forever(self, *a, **kw):
+        # Threads do not survive fork(), so each worker process starts its
+        # own pool here rather than in __init__
+        for i in xrange(self.threads):
+            t = threading.Thread(target = self._worker)
+            t.daemon = True
+            t.start()
+        for interval, fn in self.tasks:
+            t = threading.Thread(target = _every, args = (interval, fn))
+            t.daemon = True
+            t.start()
+        simple_server.WSGIServer.serve_forever(self, *a, **kw)
+
+    def _worker(self):
+        while True:
+            request, client_address = self._requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+
+def _every(interval, fn):
+    while True:
+        time.sleep(interval)
+        try:
+            fn()
+        except Exception:
+            logging.exception("Periodic task %s failed", fn.__name__)
+
+
+def refresh_popular():
+    counters.flush_views()
+    counters.refresh_leaderboard()
+
+
+def make_server(host, port, app, threads = 8, tasks = ()):
+    '''Creates a bound ThreadPoolWSGIServer for app
+
+    Args:
+        host: String interface to listen on
+        port: Int port to listen on
+        app: WSGI application
+        threads: Int number of worker threads
+        tasks: list of (Int seconds, function) to run periodically
+
+    Returns:
+        ThreadPoolWSGIServer ready for serve_forever()
+    '''
+    server = ThreadPoolWSGIServer((host, port), QuietHandler, threads,
+                                  tasks = tasks)
+    server.set_app(app)
+    return server
+
+
+def serve_prefork(server, workers):
+    '''Forks worker processes that all accept on the server's socket
+
+    The parent only supervises: it restarts workers that die and stops
+    them all on SIGINT or SIGTERM.
+
+    Args:
+        server: bound ThreadPoolWSGIServer
+        workers: Int number of worker processes
+
+    Returns:
+        None
+    '''
+    children = set()
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.add(pid)
+
+    def stop(signum, frame):
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for i in xrange(workers):
+        spawn()
+    while True:
+        pid, status = os.wait()
+        children.discard(pid)
+        spawn()
+
+
+def main_args(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("--host", default = "0.0.0.0")
+    parser.add_argument("--port", type = int, default = 8080)
+    parser.add_argument("--threads", type = int, default = 8,
+                        help = "worker threads per process")
+    parser.add_argument("--workers", type = int, default = 1,
+                        help = "pre-forked worker processes")
+    parser.add_argument("--refresh", type = int, default = 60,
+                        help = "seconds between popular posts refreshes")
+    parser.add_argument("--db", help = "SQLite database path. "
+                        "Overrides BLOG_SQLITE_PATH")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = main_args()
+    if args.db:
+        os.environ["BLOG_SQLITE_PATH"] = args.db
+    # No task queue here, so views are flushed by a periodic task instead
+    counters.view_buffer.defer = False
+    changes.set_threads(args.threads)
+    # Create the schema once before forking.  Workers open their own pools
+    storage.get_backend()
+    tasks = [(counters.FLUSH_INTERVAL, counters.flush_views),
+             (args.refresh, refresh_popular)]
+    server = make_server(args.host, args.port, static_app(main.app),
+                         args.threads, tasks = tasks)
+    print("Serving on http://%s:%d/ with %d worker(s) x %d thread(s)"
+          % (args.host, args.port, args.workers, args.threads))
+    if args.workers > 1:
+        serve_prefork(server, args.workers)
+    else:
+        server.serve_forever()
@@ -0,0 +1,790 @@
+'''SQLite storage backend for running the blog without App Engine.
+
+The database runs in WAL mode so readers never block the single writer, and
+connections are pooled per process.  Rows are returned as Post, Comment and
+User objects that mirror the data.py models closely enough for handlers and
+templates to use either backend.
+'''
+
+import base64
+import contextlib
+import datetime
+import os
+import sqlite3
+import threading
+import Queue
+
+import rendering
+import hashing
+import storage
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL,
+    password TEXT NOT NULL,
+    email TEXT,
+    created TIMESTAMP NOT NULL,
+    last_modified TIMESTAMP NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_username ON users (username);
+
+CREATE TABLE IF NOT EXISTS posts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title TEXT NOT NULL,
+    content TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    created TIMESTAMP NOT NULL,
+    last_modified TIMESTAMP NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0,
+    tags TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS posts_created ON posts (created DESC);
+CREATE INDEX IF NOT EXISTS posts_user_id ON posts (user_id, created DESC);
+
+CREATE TABLE IF NOT EXISTS post_tags (
+    tag TEXT NOT NULL,
+    post_id INTEGER NOT NULL REFERENCES posts (id) ON DELETE CASCADE,
+    created TIMESTAMP NOT NULL,
+    PRIMARY KEY (tag, post_id)
+);
+CREATE INDEX IF NOT EXISTS post_tags_tag_created
+    ON post_tags (tag, created DESC, post_id DESC);
+CREATE INDEX IF NOT EXISTS post_tags_post_id ON post_tags (post_id);
+
+CREATE TABLE IF NOT EXISTS archive_counts (
+    name TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS post_likes (
+    post_id INTEGER NOT NULL REFERENCES posts (id) ON DELETE CASCADE,
+    user_id INTEGER NOT NULL,
+    PRIMARY KEY (post_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS post_likes_user_id ON post_likes (user_id);
+
+CREATE TABLE IF NOT EXISTS comments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    post_id INTEGER NOT NULL REFERENCES posts (id) ON DELETE CASCADE,
+    user_id INTEGER NOT NULL,
+    content TEXT NOT NULL,
+    created TIMESTAMP NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS comments_post_created
+    ON comments (post_id, created DESC);
+CREATE INDEX IF NOT EXISTS comments_post_version
+    ON comments (post_id, version);
+CREATE INDEX IF NOT EXISTS comments_user_id ON comments (user_id);
+
+CREATE TABLE IF NOT EXISTS deleted_comments (
+    post_id INTEGER NOT NULL REFERENCES posts (id) ON DELETE CASCADE,
+    comment_id INTEGER NOT NULL,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (post_id, comment_id)
+);
+CREATE INDEX IF NOT EXISTS deleted_comments_post_version
+    ON deleted_comments (post_id, version);
+
+CREATE TABLE IF NOT EXISTS post_views (
+    post_id INTEGER PRIMARY KEY,
+    views INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS post_views_views ON post_views (views DESC);
+'''
+
+# Columns added after the first release, as (table, column, definition).
+# Older database files get them with ALTER TABLE on open
+ADDED_COLUMNS = [
+    ("posts", "version", "INTEGER NOT NULL DEFAULT 0"),
+    ("comments", "version", "INTEGER NOT NULL DEFAULT 0"),
+    ("posts", "tags", "TEXT NOT NULL DEFAULT ''"),
+]
+
+# SQLite refuses statements with more than 999 bound parameters
+MAX_VARIABLES = 900
+
+POST_COLUMNS = ("id, title, content, user_id, created, last_modified, "
+                "version, tags")
+COMMENT_COLUMNS = "id, post_id, user_id, content, created, version"
+USER_COLUMNS = "id, username, password, email, created, last_modified"
+
+
+def _chunks(items, size = MAX_VARIABLES):
+    '''Splits a list into lists of at most size items'''
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _placeholders(items):
+    return ",".join("?" * len(items))
+
+
+CURSOR_TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def encode_cursor(row):
+    '''Returns an opaque page cursor positioned after a Post or Comment
+
+    Pages are ordered by (created, id) descending, so the cursor only has to
+    carry the sort key of the last row.
+    '''
+    raw = "%s|%d" % (row.created.strftime(CURSOR_TIME_FORMAT), row.id)
+    return base64.urlsafe_b64encode(raw)
+
+
+def decode_cursor(cursor):
+    '''Returns (created, id) from a cursor made by encode_cursor
+
+    Raises:
+        storage.InvalidCursorError: cursor is not a valid cursor
+    '''
+    try:
+        created, row_id = base64.urlsafe_b64decode(str(cursor)).split("|")
+        created = datetime.datetime.strptime(created, CURSOR_TIME_FORMAT)
+        row_id = int(row_id)
+    except (TypeError, ValueError):
+        raise storage.InvalidCursorError(cursor)
+    if not storage.valid_id(row_id):
+        raise storage.InvalidCursorError(cursor)
+    return created, row_id
+
+
+class Key(object):
+    '''Stand in for db.Key so templates can call key().id()
+
+    Attributes:
+        kind: String entity kind.  Post, Comment or User
+    '''
+
+    def __init__(self, kind, entity_id):
+        self.kind = kind
+        self._id = entity_id
+
+    def id(self):
+        return self._id
+
+    def __eq__(self, other):
+        return (isinstance(other, Key) and
+                (self.kind, self._id) == (other.kind, other._id))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.kind, self._id))
+
+
+class Post(object):
+    '''A Post row.  Same interface as data.Post
+
+    Attributes:
+        title: String for the title of a post
+        content: Text content to be displayed. Can be text or HTML
+        user_id: Int ID of the User who wrote the post
+        likes: list of Int user IDs that liked the post
+        created: DateTime of when the post was created
+        last_modified: DateTime of when the post was last modified
+        version: Int change version.  See data.Post
+        tags: list of String tags.  Stored comma separated
+    '''
+
+    def __init__(self, storage, id, title, content, user_id, created,
+                 last_modified, version = 0, tags = None, likes = None):
+        self._storage = storage
+        self.id = id
+        self.title = title
+        self.content = content
+        self.user_id = user_id
+        self.created = created
+        self.last_modified = last_modified
+        self.version = version
+        if isinstance(tags, basestring):
+            tags = tags.split(",")
+        self.tags = [t for t in tags or [] if t]
+        self.likes = list(likes or [])
+        # Likes already in the database, so saves only write new ones
+        self._saved_likes = set(self.likes)
+
+    def key(self):
+        return Key("Post", self.id)
+
+    def like_count(self):
+        return len(self.likes)
+
+    def user_like_count(self, uid):
+        return self.likes.count(uid)
+
+    def add_like(self, uid):
+        if self.user_like_count(uid)==0:
+            self.likes.append(uid)
+
+    def render_overview(self):
+        '''Generate HTML for post data.  See data.Post.render_overview'''
+        self._render_text = self.content.replace("\n", "<br>")
+        return rendering.render_str(
+            "postoverview.html", p = self,
+            post_username=self._storage.get_user(self.user_id).username)
+
+
+class Comment(object):
+    '''A Comment row.  Same interface as data.Comment
+
+    Attributes:
+        post_id: Int ID of the Post the comment belongs to
+        user_id: Int the user who wrote the comment
+        content: Text content to be displayed
+        created: DateTime of when the comment was created
+        version: Int post change version when last added or edited
+    '''
+
+    def __init__(self, storage, id, post_id, user_id, content, created,
+                 version = 0):
+        self._storage = storage
+        self.id = id
+        self.post_id = post_id
+        self.user_id = user_id
+        self.content = content
+        self.created = created
+        self.version = version
+
+    def key(self):
+        return Key("Comment", self.id)
+
+    def get_username(self):
+        return self._storage.get_user(self.user_id).username
+
+
+class User(object):
+    '''A User row.  Same interface as data.User
+
+    Attributes:
+        username: String name for the user
+        password: String salted password hash
+        email: String of users optional email
+        created: DateTime of when the account was created
+        last_modified: DateTime of when the user last modified
+    '''
+
+    def __init__(self, storage, id, username, password, email, created,
+                 last_modified):
+        self._storage = storage
+        self.id = id
+        self.username = username
+        self.password = password
+        self.email = email
+        self.created = created
+        self.last_modified = last_modified
+
+    def key(self):
+        return Key("User", self.id)
+
+
+class ConnectionPool(object):
+    '''Pool of SQLite connections shared by the threads of one process
+
+    Connections are opened lazily up to size.  After a fork the child
+    drops the parent's connections and opens its own, so a pool created
+    before a pre-fork server starts its workers is still safe to use.
+
+    Methods:
+        connection: context manager yielding a connection in a transaction
+        open_all: opens connections until the pool is full
+        close: closes all idle connections
+    '''
+
+    def __init__(self, path, size = 8, timeout = 30):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = Queue.LifoQueue()
+        self._opened = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout = self.timeout,
+                               detect_types = sqlite3.PARSE_DECLTYPES,
+                               check_same_thread = False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def _acquire(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            try:
+                return self._idle.get_nowait()
+            except Queue.Empty:
+                if self._opened < self.size:
+                    self._opened += 1
+                    return self._connect()
+        return self._idle.get(timeout = self.timeout)
+
+    def _release(self, conn):
+        if self._pid == os.getpid():
+            self._idle.put(conn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        '''Yields a pooled connection inside a transaction
+
+        The transaction commits when the block exits normally and rolls
+        back if it raises.
+        '''
+        conn = self._acquire()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self._release(conn)
+
+    def open_all(self):
+        '''Opens connections until the pool is full'''
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            while self._opened < self.size:
+                self._opened += 1
+                self._idle.put(self._connect())
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Queue.Empty:
+                break
+
+
+class SqliteStorage(object):
+    '''Stores blog entities in a local SQLite database
+
+    Same methods as storage.DatastoreStorage.
+
+    Attributes:
+        pool: ConnectionPool for the database file
+    '''
+
+    def __init__(self, path, pool_size = 8):
+        self.pool = ConnectionPool(path, size = pool_size)
+        with self.pool.connection() as conn:
+            self._add_columns(conn)
+            conn.executescript(SCHEMA)
+
+    def _add_columns(self, conn):
+        for table, column, definition in ADDED_COLUMNS:
+            columns = [row[1] for row in
+                       conn.execute("PRAGMA table_info(%s)" % table)]
+            if columns and column not in columns:
+                conn.execute("ALTER TABLE %s ADD COLUMN %s %s"
+                             % (table, column, definition))
+
+    def _now(self):
+        return datetime.datetime.utcnow()
+
+    def _load_likes(self, conn, posts):
+        '''Fills in likes for a list of Posts with one query per chunk'''
+        by_id = dict((p.id, p) for p in posts)
+        ids = list(by_id)
+        for chunk in _chunks(ids):
+            rows = conn.execute(
+                "SELECT post_id, user_id FROM post_likes "
+                "WHERE post_id IN (%s) ORDER BY rowid" % _placeholders(chunk),
+                chunk)
+            for post_id, user_id in rows:
+                by_id[post_id].likes.append(user_id)
+        for p in posts:
+            p._saved_likes = set(p.likes)
+        return posts
+
+    def _posts(self, conn, rows):
+        return self._load_likes(conn, [Post(self, *row) for row in rows])
+
+    def get_post(self, post_id):
+        return self.get_posts([post_id])[0]
+
+    def get_posts(self, post_ids):
+        '''Returns Posts for a list of IDs
+
+        Args:
+            post_ids: list of Int post IDs
+
+        Returns:
+            list of Post objects in the order of post_ids.  None if missing
+        '''
+        post_ids = [int(pid) for pid in post_ids]
+        found = {}
+        with self.pool.connection() as conn:
+            for chunk in _chunks(filter(storage.valid_id, post_ids)):
+                rows = conn.execute(
+                    "SELECT %s FROM posts WHERE id IN (%s)"
+                    % (POST_COLUMNS, _placeholders(chunk)), chunk)
+                for p in self._posts(conn, rows.fetchall()):
+                    found[p.id] = p
+        return [found.get(pid) for pid in post_ids]
+
+    def recent_posts(self, limit = None):
+        sql = "SELECT %s FROM posts ORDER BY created DESC, id DESC" % (
+            POST_COLUMNS)
+        params = ()
+        if limit is not None:
+            sql += " LIMIT ?"
+            params = (limit,)
+        with self.pool.connection() as conn:
+            return self._posts(conn, conn.execute(sql, params).fetchall())
+
+    def _page_sql(self, sql, params, limit, cursor, id_column = "id"):
+        '''Adds keyset pagination on (created, id) descending to a query'''
+        if cursor:
+            created, row_id = decode_cursor(cursor)
+            sql += (" AND (created < ? OR (created = ? AND %s < ?))"
+                    % id_column)
+            params += (created, created, row_id)
+        sql += " ORDER BY created DESC, %s DESC LIMIT ?" % id_column
+        return sql, params + (limit,)
+
+    def _posts_page(self, sql, params, limit, cursor):
+        sql, params = self._page_sql(sql, params, limit, cursor)
+        with self.pool.connection() as conn:
+            posts = self._posts(conn, conn.execute(sql, params).fetchall())
+        return posts, (encode_cursor(posts[-1]) if len(posts) == limit
+                       else None)
+
+    def recent_posts_page(self, limit, cursor = None):
+        return self._posts_page("SELECT %s FROM posts WHERE 1"
+                                % POST_COLUMNS, (), limit, cursor)
+
+    def posts_by_tag(self, tag, limit, cursor = None):
+        # Page over the (tag, created) index, then load the posts by ID
+        sql, params = self._page_sql(
+            "SELECT post_id FROM post_tags WHERE tag = ?", (tag,), limit,
+            cursor, id_column = "post_id")
+        with self.pool.connection() as conn:
+            ids = [row[0] for row in conn.execute(sql, params)]
+        posts = [p for p in self.get_posts(ids) if p]
+        return posts, (encode_cursor(posts[-1]) if len(ids) == limit
+                       else None)
+
+    def posts_by_author(self, user_id, limit, cursor = None):
+        return self._posts_page("SELECT %s FROM posts WHERE user_id = ?"
+                                % POST_COLUMNS, (int(user_id),), limit,
+                                cursor)
+
+    def posts_by_month(self, year, month, limit, cursor = None):
+        start, end = storage.month_range(year, month)
+        return self._posts_page("SELECT %s FROM posts "
+                                "WHERE created >= ? AND created < ?"
+                                % POST_COLUMNS, (start, end), limit, cursor)
+
+    def _apply_counts(self, conn, deltas):
+        if not deltas:
+            return
+        conn.executemany("INSERT OR IGNORE INTO archive_counts "
+                         "(name, count) VALUES (?, 0)",
+                         [(n,) for n in deltas])
+        conn.executemany("UPDATE archive_counts "
+                         "SET count = MAX(0, count + ?) WHERE name = ?",
+                         [(d, n) for n, d in deltas.items()])
+
+    def _write_tags(self, conn, post, old_tags):
+        '''Moves a Post's post_tags rows and archive counts to its tags'''
+        old, new = set(old_tags), set(post.tags)
+        conn.executemany("DELETE FROM post_tags WHERE tag = ? AND post_id = ?",
+                         [(t, post.id) for t in old - new])
+        conn.executemany("INSERT OR IGNORE INTO post_tags "
+                         "(tag, post_id, created) VALUES (?, ?, ?)",
+                         [(t, post.id, post.created) for t in new - old])
+        self._apply_counts(conn, storage.count_deltas(
+            ["tag:%s" % t for t in old], ["tag:%s" % t for t in new]))
+
+    def create_post(self, title, content, user_id, tags = ()):
+        now = self._now()
+        with self.pool.connection() as conn:
+            p = Post(self, None, title, content, user_id, now, now,
+                     tags = list(tags))
+            cur = conn.execute(
+                "INSERT INTO posts (title, content, user_id, created, "
+                "last_modified, tags) VALUES (?, ?, ?, ?, ?, ?)",
+                (title, content, user_id, now, now, ",".join(p.tags)))
+            p.id = cur.lastrowid
+            p.add_like(user_id)
+            self._write_likes(conn, p)
+            self._write_tags(conn, p, [])
+            self._apply_counts(conn, {"month:%s" % now.strftime("%Y-%m"): 1})
+        return p
+
+    def archive_counts(self, names):
+        counts = dict((n, 0) for n in names)
+        ids = list(counts)
+        with self.pool.connection() as conn:
+            for chunk in _chunks(ids):
+                counts.update(conn.execute(
+                    "SELECT name, count FROM archive_counts "
+                    "WHERE name IN (%s)" % _placeholders(chunk), chunk))
+        return counts
+
+    def rebuild_archive_counts(self, batch_size = 500, background = False):
+        # One quick transaction, so it always runs at once.  batch_size is
+        # only used by the datastore
+        with self.pool.connection() as conn:
+            conn.execute("DELETE FROM archive_counts")
+            conn.execute("INSERT INTO archive_counts (name, count) "
+                         "SELECT 'month:' || substr(created, 1, 7), COUNT(*) "
+                         "FROM posts GROUP BY substr(created, 1, 7)")
+            conn.execute("INSERT INTO archive_counts (name, count) "
+                         "SELECT 'tag:' || tag, COUNT(*) FROM post_tags "
+                         "GROUP BY tag")
+            return dict(conn.execute("SELECT name, count FROM archive_counts"))
+
+    def _write_likes(self, conn, post):
+        current = set(post.likes)
+        added = [(post.id, uid) for uid in post.likes
+                 if uid not in post._saved_likes]
+        removed = [(post.id, uid) for uid in post._saved_likes
+                   if uid not in current]
+        if added:
+            conn.executemany("INSERT OR IGNORE INTO post_likes "
+                             "(post_id, user_id) VALUES (?, ?)", added)
+        if removed:
+            conn.executemany("DELETE FROM post_likes "
+                             "WHERE post_id = ? AND user_id = ?", removed)
+        post._saved_likes = current
+
+    def _bump_version(self, conn, post_id):
+        '''Increments a Post's change version and returns the new value
+
+        The UPDATE takes the write lock, so the read back inside the same
+        transaction always sees this bump.
+        '''
+        conn.execute("UPDATE posts SET version = version + 1 WHERE id = ?",
+                     (post_id,))
+        return conn.execute("SELECT version FROM posts WHERE id = ?",
+                            (post_id,)).fetchone()[0]
+
+    def save_post(self, post):
+        post.last_modified = self._now()
+        with self.pool.connection() as conn:
+            old_tags = conn.execute("SELECT tags FROM posts WHERE id = ?",
+                                    (post.id,)).fetchone()[0]
+            conn.execute(
+                "UPDATE posts SET title = ?, content = ?, last_modified = ?, "
+                "tags = ? WHERE id = ?",
+                (post.title, post.content, post.last_modified,
+                 ",".join(post.tags), post.id))
+            self._write_likes(conn, post)
+            self._write_tags(conn, post, [t for t in old_tags.split(",") if t])
+            post.version = self._bump_version(conn, post.id)
+
+    def delete_post(self, post):
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT created, tags FROM posts WHERE id = ?",
+                               (post.id,)).fetchone()
+            if row:
+                tags = [t for t in row[1].split(",") if t]
+                self._apply_counts(conn, storage.count_deltas(
+                    storage.archive_names(row[0], tags), []))
+            conn.execute("DELETE FROM posts WHERE id = ?", (post.id,))
+
+    def get_comments(self, post):
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                "SELECT %s FROM comments WHERE post_id = ? "
+                "ORDER BY created DESC, id DESC" % COMMENT_COLUMNS,
+                (post.id,))
+            return [Comment(self, *row) for row in rows]
+
+    def comments_page(self, post, limit, cursor = None):
+        sql, params = self._page_sql(
+            "SELECT %s FROM comments WHERE post_id = ?" % COMMENT_COLUMNS,
+            (post.id,), limit, cursor)
+        with self.pool.connection() as conn:
+            comments = [Comment(self, *row)
+                        for row in conn.execute(sql, params)]
+        return comments, (encode_cursor(comments[-1])
+                          if len(comments) == limit else None)
+
+    def get_comment(self, post, comment_id):
+        if not storage.valid_id(int(comment_id)):
+            return None
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT %s FROM comments WHERE id = ? AND post_id = ?"
+                % COMMENT_COLUMNS, (int(comment_id), post.id)).fetchone()
+        return row and Comment(self, *row)
+
+    def create_comment(self, post, user_id, content):
+        now = self._now()
+        with self.pool.connection() as conn:
+            post.version = self._bump_version(conn, post.id)
+            cur = conn.execute(
+                "INSERT INTO comments (post_id, user_id, content, created, "
+                "version) VALUES (?, ?, ?, ?, ?)",
+                (post.id, user_id, content, now, post.version))
+        return Comment(self, cur.lastrowid, post.id, user_id, content, now,
+                       post.version)
+
+    def save_comment(self, comment):
+        with self.pool.connection() as conn:
+            comment.version = self._bump_version(conn, comment.post_id)
+            conn.execute("UPDATE comments SET content = ?, version = ? "
+                         "WHERE id = ?",
+                         (comment.content, comment.version, comment.id))
+
+    def changed_comments(self, post, since, limit = 100):
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                "SELECT %s FROM comments WHERE post_id = ? AND version > ? "
+                "ORDER BY version LIMIT ?" % COMMENT_COLUMNS,
+                (post.id, int(since), limit))
+            return [Comment(self, *row) for row in rows]
+
+    def delete_comment(self, comment):
+        with self.pool.connection() as conn:
+            version = self._bump_version(conn, comment.post_id)
+            conn.execute("DELETE FROM comments WHERE id = ?", (comment.id,))
+            conn.execute("INSERT OR REPLACE INTO deleted_comments "
+                         "(post_id, comment_id, version) VALUES (?, ?, ?)",
+                         (comment.post_id, comment.id, version))
+        return version
+
+    def deleted_comments(self, post, since, limit = 100):
+        with self.pool.connection() as conn:
+            return list(conn.execute(
+                "SELECT comment_id, version FROM deleted_comments "
+                "WHERE post_id = ? AND version > ? ORDER BY version LIMIT ?",
+                (post.id, int(since), limit)))
+
+    def get_user(self, uid):
+        return self.get_users([uid])[0]
+
+    def get_users(self, uids):
+        '''Returns Users for a list of IDs
+
+        Args:
+            uids: list of Int user IDs
+
+        Returns:
+            list of User objects in the order of uids.  None if missing
+        '''
+        uids = [int(uid) for uid in uids]
+        found = {}
+        with self.pool.connection() as conn:
+            for chunk in _chunks(sorted(set(uids))):
+                rows = conn.execute(
+                    "SELECT %s FROM users WHERE id IN (%s)"
+                    % (USER_COLUMNS, _placeholders(chunk)), chunk)
+                for row in rows:
+                    found[row[0]] = User(self, *row)
+        return [found.get(uid) for uid in uids]
+
+    def add_views(self, deltas):
+        '''Adds view counts to posts in one transaction
+
+        SQLite has a single writer, so each post keeps one counter row.
+
+        Args:
+            deltas: dict of Int post ID to Int views to add
+
+        Returns:
+            dict of views not written.  Always empty, the transaction
+            either writes everything or raises
+        '''
+        with self.pool.connection() as conn:
+            conn.executemany("INSERT OR IGNORE INTO post_views "
+                             "(post_id, views) VALUES (?, 0)",
+                             [(pid,) for pid in deltas])
+            conn.executemany("UPDATE post_views SET views = views + ? "
+                             "WHERE post_id = ?",
+                             [(n, pid) for pid, n in deltas.items()])
+        return {}
+
+    def view_counts(self, post_ids):
+        counts = dict((int(pid), 0) for pid in post_ids)
+        ids = list(counts)
+        with self.pool.connection() as conn:
+            for chunk in _chunks(ids):
+                rows = conn.execute(
+                    "SELECT post_id, views FROM post_views "
+                    "WHERE post_id IN (%s)" % _placeholders(chunk), chunk)
+                counts.update(rows)
+        return counts
+
+    def top_viewed(self, limit):
+        with self.pool.connection() as conn:
+            return [tuple(row) for row in conn.execute(
+                "SELECT post_id, views FROM post_views "
+                "ORDER BY views DESC, post_id LIMIT ?", (limit,))]
+
+    def warmup(self, limit = 10):
+        '''Opens every pooled connection and loads the front page rows
+
+        Args:
+            limit: Int number of recent posts to load
+
+        Returns:
+            list of recent Post objects
+        '''
+        self.pool.open_all()
+        posts = self.recent_posts(limit)
+        self.get_users(set(p.user_id for p in posts))
+        return posts
+
+    def load_users(self, rows):
+        with self.pool.connection() as conn:
+            conn.executemany(
+                "INSERT INTO users (id, username, password, email, created, "
+                "last_modified) VALUES (?, ?, ?, ?, ?, ?)",
+                [(r.id, r.username, r.password, r.email, r.created, r.created)
+                 for r in rows])
+
+    def load_posts(self, rows):
+        with self.pool.connection() as conn:
+            conn.executemany(
+                "INSERT INTO posts (id, title, content, user_id, created, "
+                "last_modified, version, tags) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(r.id, r.title, r.content, r.user_id, r.created, r.created,
+                  r.version, ",".join(r.tags)) for r in rows])
+            conn.executemany("INSERT INTO post_likes (post_id, user_id) "
+                             "VALUES (?, ?)",
+                             [(r.id, uid) for r in rows for uid in r.likes])
+            conn.executemany("INSERT INTO post_tags (tag, post_id, created) "
+                             "VALUES (?, ?, ?)",
+                             [(t, r.id, r.created) for r in rows
+                              for t in r.tags])
+
+    def load_comments(self, rows):
+        with self.pool.connection() as conn:
+            conn.executemany(
+                "INSERT INTO comments (id, post_id, user_id, content, created, "
+                "version) VALUES (?, ?, ?, ?, ?, ?)",
+                [(r.id, r.post_id, r.user_id, r.content, r.created, r.version)
+                 for r in rows])
+
+    def user_by_name(self, name):
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT %s FROM users WHERE username = ? LIMIT 1"
+                % USER_COLUMNS, (name,)).fetchone()
+        return row and User(self, *row)
+
+    def register_user(self, name, pw, email = None):
+        now = self._now()
+        pw_hash = hashing.make_pw_hash(name, pw)
+        with self.pool.connection() as conn:
+            cur = conn.execute(
+                "INSERT INTO users (username, password, email, created, "
+                "last_modified) VALUES (?, ?, ?, ?, ?)",
+                (name, pw_hash, email, now, now))
+        return User(self, cur.lastrowid, name, pw_hash, email, now, now)
+
+    def login(self, name, pw):
+        u = self.user_by_name(name)
+        if u and hashing.valid_pw(name, pw, u.password):
+            return u
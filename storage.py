@@ -0,0 +1,658 @@
+'''Storage backends for blog Posts, Comments and Users.
+
+Handlers never talk to a database directly.  They go through the backend
+returned by get_backend(), which is chosen with the BLOG_STORAGE
+environment variable:
+
+    datastore: Google Cloud Datastore through data.py.  Default
+    sqlite: local SQLite file, see sqlite_storage.py.  The file path is
+            read from BLOG_SQLITE_PATH, default blog.db
+
+Every backend exposes the same methods and returns entities with the same
+interface as the data.py models (key().id(), like_count(), render_overview()
+and so on) so templates work unchanged.
+'''
+
+import datetime
+import logging
+import os
+import random
+import threading
+
+DEFAULT_BACKEND = "datastore"
+
+# View counter shards per post on the datastore backend
+VIEW_SHARDS = 8
+# Entity groups the datastore allows in one cross group transaction
+MAX_XG_GROUPS = 25
+# Both backends store entity IDs as signed 64 bit integers
+MAX_ID = 2 ** 63 - 1
+
+
+class InvalidCursorError(ValueError):
+    '''Raised when a page cursor from a client cannot be decoded'''
+
+
+def valid_id(entity_id):
+    '''Returns True if an Int could be the ID of a stored entity
+
+    IDs from URLs and clients are checked before they reach a backend,
+    which would fail on IDs outside 64 bits instead of finding nothing.
+    '''
+    return 0 < entity_id <= MAX_ID
+
+
+def month_range(year, month):
+    '''Returns the UTC (start, end) datetimes of a calendar month
+
+    Args:
+        year: Int year
+        month: Int month, 1 to 12
+
+    Returns:
+        (start, end) where end is the first instant of the next month
+
+    Raises:
+        ValueError: the month does not exist
+    '''
+    start = datetime.datetime(int(year), int(month), 1)
+    if start.month == 12:
+        return start, start.replace(year = start.year + 1, month = 1)
+    return start, start.replace(month = start.month + 1)
+
+
+def archive_names(created, tags):
+    '''Returns the archive count names a post belongs to
+
+    Args:
+        created: DateTime the post was created
+        tags: list of String tags
+
+    Returns:
+        list of String names.  "month:<yyyy-mm>" and "tag:<tag>" per tag
+    '''
+    return (["month:%s" % created.strftime("%Y-%m")] +
+            ["tag:%s" % t for t in tags])
+
+
+def count_deltas(old_names, new_names):
+    '''Returns count changes for moving a post between archives'''
+    deltas = {}
+    for name in old_names:
+        deltas[name] = deltas.get(name, 0) - 1
+    for name in new_names:
+        deltas[name] = deltas.get(name, 0) + 1
+    return dict((n, d) for n, d in deltas.items() if d)
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    '''Returns the storage backend for this process
+
+    The backend is created on first use so that importing main.py never
+    pulls in the App Engine SDK when running on SQLite.
+
+    Args:
+        None
+
+    Returns:
+        Storage backend instance.  DatastoreStorage or SqliteStorage
+    '''
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = create_backend(
+                    os.environ.get("BLOG_STORAGE", DEFAULT_BACKEND))
+    return _backend
+
+
+def set_backend(backend):
+    '''Replaces the storage backend for this process
+
+    Args:
+        backend: Storage backend instance, or None to reset to the default
+
+    Returns:
+        None
+    '''
+    global _backend
+    _backend = backend
+
+
+def create_backend(name):
+    '''Creates a storage backend by name
+
+    Args:
+        name: String backend name.  "datastore" or "sqlite"
+
+    Returns:
+        New storage backend instance
+
+    Raises:
+        ValueError: the backend name is unknown
+    '''
+    if name == "datastore":
+        return DatastoreStorage()
+    if name == "sqlite":
+        import sqlite_storage
+        return sqlite_storage.SqliteStorage(
+            os.environ.get("BLOG_SQLITE_PATH", "blog.db"))
+    raise ValueError("Unknown storage backend: %s" % name)
+
+
+class DatastoreStorage(object):
+    '''Stores blog entities in Google Cloud Datastore
+
+    Thin wrapper over the models in data.py.  Posts live under blog_key()
+    and Users under users_key().  Comments are children of their Post.
+
+    Methods:
+        get_post: returns a Post by ID
+        get_posts: returns Posts for a list of IDs with one batch get
+        recent_posts: returns Posts newest first
+        recent_posts_page: returns one cursor page of Posts newest first
+        create_post: stores and returns a new Post
+        save_post: writes changes to a Post and bumps its version
+        delete_post: deletes a Post
+        posts_by_tag: returns one cursor page of Posts with a tag
+        posts_by_author: returns one cursor page of a User's Posts
+        posts_by_month: returns one cursor page of a month's Posts
+        archive_counts: returns precomputed tag and month post counts
+        rebuild_archive_counts: recounts all tag and month archives
+        get_comments: returns Comments for a Post newest first
+        comments_page: returns one cursor page of a Post's Comments
+        get_comment: returns a Comment of a Post by ID
+        create_comment: stores and returns a new Comment
+        save_comment: writes changes to a Comment
+        changed_comments: returns Comments changed after a post version
+        delete_comment: deletes a Comment and bumps its Post's version
+        deleted_comments: returns Comments deleted after a post version
+        get_user: returns a User by ID
+        get_users: returns Users for a list of IDs with one batch get
+        user_by_name: returns a User by username
+        register_user: stores and returns a new User
+        login: returns a User if the password is correct
+        add_views: adds buffered view counts to sharded counters
+        view_counts: returns total views for posts
+        top_viewed: returns the most viewed posts
+        warmup: loads the front page entities on a new instance
+        load_users: writes a batch of generated Users with fixed IDs
+        load_posts: writes a batch of generated Posts with fixed IDs
+        load_comments: writes a batch of generated Comments with fixed IDs
+    '''
+
+    def __init__(self):
+        # Imported here so SQLite deployments never need the App Engine SDK
+        import data
+        from google.appengine.ext import db
+        self.data = data
+        self.db = db
+
+    def get_post(self, post_id):
+        return self.get_posts([post_id])[0]
+
+    def get_posts(self, post_ids):
+        '''Returns Posts for a list of IDs using one batch get
+
+        Args:
+            post_ids: list of Int post IDs
+
+        Returns:
+            list of Post objects in the order of post_ids.  None if missing
+        '''
+        post_ids = [int(pid) for pid in post_ids]
+        keys = [self.db.Key.from_path("Post", pid,
+                                      parent = self.data.blog_key())
+                for pid in post_ids if valid_id(pid)]
+        found = iter(self.db.get(keys) if keys else [])
+        return [next(found) if valid_id(pid) else None for pid in post_ids]
+
+    def recent_posts(self, limit = None):
+        q = self.data.Post.all().order("-created")
+        if limit is None:
+            return q
+        return q.fetch(limit)
+
+    def _page(self, q, limit, cursor):
+        try:
+            if cursor:
+                q.with_cursor(cursor)
+            items = q.fetch(limit)
+        except (self.db.BadValueError, self.db.BadRequestError):
+            raise InvalidCursorError(cursor)
+        return items, (q.cursor() if len(items) == limit else None)
+
+    def recent_posts_page(self, limit, cursor = None):
+        '''Returns one page of Posts newest first
+
+        Args:
+            limit: Int maximum number of posts
+            cursor: String cursor from the previous page, or None
+
+        Returns:
+            (list of Posts, String cursor for the next page or None)
+
+        Raises:
+            InvalidCursorError: cursor is not a valid cursor
+        '''
+        return self._page(self.data.Post.all().order("-created"), limit,
+                          cursor)
+
+    def _xg(self, txn, *args):
+        '''Runs txn(*args) in a cross group transaction.  Posts and their
+        ArchiveCounts are in different entity groups'''
+        return self.db.run_in_transaction_options(
+            self.db.create_transaction_options(xg = True), txn, *args)
+
+    def _apply_counts(self, deltas):
+        '''Adds deltas to ArchiveCounts.  Call inside a transaction'''
+        if not deltas:
+            return []
+        names = list(deltas)
+        keys = [self.db.Key.from_path("ArchiveCount", n) for n in names]
+        counts = self.db.get(keys)
+        for i, name in enumerate(names):
+            if counts[i] is None:
+                counts[i] = self.data.ArchiveCount(key = keys[i])
+            counts[i].count = max(0, counts[i].count + deltas[name])
+        return counts
+
+    def create_post(self, title, content, user_id, tags = ()):
+        '''Stores a new Post and counts it in its month and tag archives
+
+        Args:
+            title: String title
+            content: String content
+            user_id: Int ID of the author, who also likes the post
+            tags: list of String tags
+
+        Returns:
+            new Post entity
+        '''
+        p = self.data.Post(parent = self.data.blog_key(), title = title,
+                           content = content, likes = [user_id],
+                           user_id = user_id, tags = list(tags),
+                           created = datetime.datetime.utcnow())
+        def txn():
+            counts = self._apply_counts(
+                count_deltas([], archive_names(p.created, p.tags)))
+            self.db.put([p] + counts)
+        self._xg(txn)
+        return p
+
+    def save_post(self, post):
+        '''Writes changes to a Post and bumps its change version
+
+        Args:
+            post: Post entity
+
+        Returns:
+            None
+        '''
+        def txn():
+            current = self.db.get(post.key())
+            post.version = (current and current.version or 0) + 1
+            counts = []
+            if current and current.tags != post.tags:
+                counts = self._apply_counts(count_deltas(
+                    archive_names(current.created, current.tags),
+                    archive_names(post.created, post.tags)))
+            self.db.put([post] + counts)
+        self._xg(txn)
+
+    def delete_post(self, post):
+        def txn():
+            current = self.db.get(post.key())
+            if current:
+                counts = self._apply_counts(count_deltas(
+                    archive_names(current.created, current.tags), []))
+                self.db.put(counts)
+                current.delete()
+        self._xg(txn)
+
+    def posts_by_tag(self, tag, limit, cursor = None):
+        '''Returns one page of Posts with a tag, newest first
+
+        Args:
+            tag: String tag
+            limit: Int maximum number of posts
+            cursor: String cursor from the previous page, or None
+
+        Returns:
+            (list of Posts, String cursor for the next page or None)
+        '''
+        q = self.data.Post.all().filter("tags =", tag).order("-created")
+        return self._page(q, limit, cursor)
+
+    def posts_by_author(self, user_id, limit, cursor = None):
+        q = (self.data.Post.all().filter("user_id =", int(user_id))
+             .order("-created"))
+        return self._page(q, limit, cursor)
+
+    def posts_by_month(self, year, month, limit, cursor = None):
+        start, end = month_range(year, month)
+        q = (self.data.Post.all().filter("created >=", start)
+             .filter("created <", end).order("-created"))
+        return self._page(q, limit, cursor)
+
+    def archive_counts(self, names):
+        '''Returns precomputed post counts for listing pages
+
+        Args:
+            names: list of String names.  "tag:<tag>" or "month:<yyyy-mm>"
+
+        Returns:
+            dict of String name to Int count
+        '''
+        keys = [self.db.Key.from_path("ArchiveCount", n) for n in names]
+        return dict((n, c.count if c else 0)
+                    for n, c in zip(names, self.db.get(keys)))
+
+    def rebuild_archive_counts(self, batch_size = 500, background = False):
+        '''Recounts every month and tag archive from all Posts
+
+        For posts written before archive counts existed, or to repair
+        drifted counts.  Runs archives.ArchiveRecount, a resumable mapper
+        that replaces the counts only once every Post has been read.
+        Starting a recount again restarts it from the first Post, and a
+        recount still running stops at its next batch.
+
+        Args:
+            batch_size: Int posts read per batch
+            background: Boolean.  If True run in chained deferred tasks,
+                throttled, and return at once
+
+        Returns:
+            dict of String name to Int count that was stored, or None when
+            running in the background
+        '''
+        import archives
+        if background:
+            recount = archives.ArchiveRecount(batch_size)
+            recount.reset()
+            recount.start()
+            return None
+        recount = archives.ArchiveRecount(batch_size, max_per_second = None)
+        recount.reset()
+        recount.run()
+        return recount.totals
+
+    def get_comments(self, post):
+        return self.data.Comment.all().ancestor(post).order("-created")
+
+    def comments_page(self, post, limit, cursor = None):
+        '''Returns one page of a Post's Comments newest first
+
+        Args:
+            post: Post entity the comments belong to
+            limit: Int maximum number of comments
+            cursor: String cursor from the previous page, or None
+
+        Returns:
+            (list of Comments, String cursor for the next page or None)
+
+        Raises:
+            InvalidCursorError: cursor is not a valid cursor
+        '''
+        return self._page(self.get_comments(post), limit, cursor)
+
+    def get_comment(self, post, comment_id):
+        if not valid_id(long(comment_id)):
+            return None
+        return self.data.Comment.get_by_id(long(comment_id),
+                                           parent = post.key())
+
+    def _put_with_version(self, post_key, comment):
+        '''Bumps the Post change version and stamps it on the Comment
+
+        Comments share their Post's entity group, so both are written in
+        one transaction and versions never repeat.
+
+        Returns:
+            Int new change version of the Post
+        '''
+        def txn():
+            current = self.db.get(post_key)
+            current.version = (current.version or 0) + 1
+            comment.version = current.version
+            self.db.put([current, comment])
+            return current.version
+        return self.db.run_in_transaction(txn)
+
+    def create_comment(self, post, user_id, content):
+        c = self.data.Comment(parent = post.key(), user_id = user_id,
+                              content = content)
+        post.version = self._put_with_version(post.key(), c)
+        return c
+
+    def save_comment(self, comment):
+        self._put_with_version(comment.parent_key(), comment)
+
+    def changed_comments(self, post, since, limit = 100):
+        '''Returns Comments added or edited after a change version
+
+        Args:
+            post: Post entity the comments belong to
+            since: Int change version the client already has
+            limit: Int maximum number of comments
+
+        Returns:
+            list of Comments, oldest change first
+        '''
+        return (self.data.Comment.all().ancestor(post)
+                .filter("version >", int(since)).order("version")
+                .fetch(limit))
+
+    def delete_comment(self, comment):
+        '''Deletes a Comment and records the deletion for the changes feed
+
+        Args:
+            comment: Comment entity
+
+        Returns:
+            Int new change version of the Post
+        '''
+        post_key = comment.parent_key()
+        def txn():
+            current = self.db.get(post_key)
+            current.version = (current.version or 0) + 1
+            deleted = self.data.DeletedComment(
+                key = self.db.Key.from_path("DeletedComment",
+                                            comment.key().id(),
+                                            parent = post_key),
+                version = current.version)
+            self.db.put([current, deleted])
+            self.db.delete(comment)
+            return current.version
+        return self.db.run_in_transaction(txn)
+
+    def deleted_comments(self, post, since, limit = 100):
+        '''Returns Comments deleted after a change version
+
+        Args:
+            post: Post entity the comments belonged to
+            since: Int change version the client already has
+            limit: Int maximum number of comments
+
+        Returns:
+            list of (Int comment ID, Int version), oldest deletion first
+        '''
+        deleted = (self.data.DeletedComment.all().ancestor(post)
+                   .filter("version >", int(since)).order("version")
+                   .fetch(limit))
+        return [(d.key().id(), d.version) for d in deleted]
+
+    def get_user(self, uid):
+        return self.data.User.by_id(int(uid))
+
+    def get_users(self, uids):
+        '''Returns Users for a list of IDs using one batch get
+
+        Args:
+            uids: list of Int user IDs
+
+        Returns:
+            list of User objects in the order of uids.  None if missing
+        '''
+        keys = [self.db.Key.from_path("User", int(uid),
+                                      parent = self.data.users_key())
+                for uid in uids]
+        return self.db.get(keys) if keys else []
+
+    def user_by_name(self, name):
+        return self.data.User.by_name(name)
+
+    def _add_shard_views(self, post_ids, shard, deltas):
+        '''Adds views to one shard of each post.  Call in a transaction'''
+        keys = [self.data.PostViewShard.key_for(pid, shard)
+                for pid in post_ids]
+        shards = self.db.get(keys)
+        for i, pid in enumerate(post_ids):
+            if shards[i] is None:
+                shards[i] = self.data.PostViewShard(
+                    key = keys[i], post_id = pid, views = 0)
+            shards[i].views += deltas[pid]
+        self.db.put(shards)
+
+    def add_views(self, deltas):
+        '''Adds view counts to posts in sharded counters
+
+        All posts in the call share one randomly picked shard, which keeps
+        contention between instances low.  Every shard is its own entity
+        group and is read and written in a transaction, so concurrent
+        flushes to the same shard never lose increments.  Posts are
+        written MAX_XG_GROUPS per cross group transaction.
+
+        Args:
+            deltas: dict of Int post ID to Int views to add
+
+        Returns:
+            dict of Int post ID to Int views that were not written, because
+            their transaction failed.  Empty when everything was written
+        '''
+        shard = random.randrange(VIEW_SHARDS)
+        post_ids = list(deltas)
+        failed = {}
+        for i in xrange(0, len(post_ids), MAX_XG_GROUPS):
+            chunk = post_ids[i:i + MAX_XG_GROUPS]
+            try:
+                self._xg(self._add_shard_views, chunk, shard, deltas)
+            except Exception:
+                logging.exception("Failed to add views for %d posts",
+                                  len(chunk))
+                failed.update((pid, deltas[pid]) for pid in chunk)
+        return failed
+
+    def view_counts(self, post_ids):
+        '''Returns total views for posts by summing all of their shards
+
+        Args:
+            post_ids: list of Int post IDs
+
+        Returns:
+            dict of Int post ID to Int views
+        '''
+        counts = dict((int(pid), 0) for pid in post_ids)
+        keys = [self.data.PostViewShard.key_for(pid, shard)
+                for pid in counts for shard in xrange(VIEW_SHARDS)]
+        for s in self.db.get(keys):
+            if s:
+                counts[s.post_id] += s.views
+        return counts
+
+    def top_viewed(self, limit):
+        '''Returns the most viewed posts
+
+        The biggest shards pick the candidate posts, whose full totals are
+        then summed.  A post in the true top limit almost always has a shard
+        among the biggest limit * VIEW_SHARDS.
+
+        Args:
+            limit: Int number of posts
+
+        Returns:
+            list of (Int post ID, Int views), most viewed first
+        '''
+        shards = self.data.PostViewShard.all().order("-views").fetch(
+            limit * VIEW_SHARDS)
+        counts = self.view_counts(set(s.post_id for s in shards))
+        return sorted(counts.items(), key = lambda c: (-c[1], c[0]))[:limit]
+
+    def warmup(self, limit = 10):
+        '''Opens datastore RPCs and loads the front page posts and authors
+
+        Args:
+            limit: Int number of recent posts to load
+
+        Returns:
+            list of recent Post objects
+        '''
+        posts = self.recent_posts(limit)
+        self.get_users(set(p.user_id for p in posts))
+        return posts
+
+    def _reserve_ids(self, kind, parent, ids):
+        '''Keeps the datastore from handing out IDs that were loaded'''
+        self.db.allocate_id_range(self.db.Key.from_path(kind, 1,
+                                                        parent = parent),
+                                  min(ids), max(ids))
+
+    def load_users(self, rows):
+        '''Writes generated Users with one batch put
+
+        For fixtures.py.  IDs are taken from the rows and reserved, so later
+        Users never collide with them.
+
+        Args:
+            rows: list of fixtures.UserRow
+
+        Returns:
+            None
+        '''
+        parent = self.data.users_key()
+        self._reserve_ids("User", parent, [r.id for r in rows])
+        self.db.put([self.data.User(
+            key = self.db.Key.from_path("User", r.id, parent = parent),
+            username = r.username, password = r.password, email = r.email,
+            created = r.created) for r in rows])
+
+    def load_posts(self, rows):
+        '''Writes generated Posts with one batch put.  See load_users
+
+        Archive counts are not updated.  Call rebuild_archive_counts after
+        the last batch.
+        '''
+        parent = self.data.blog_key()
+        self._reserve_ids("Post", parent, [r.id for r in rows])
+        self.db.put([self.data.Post(
+            key = self.db.Key.from_path("Post", r.id, parent = parent),
+            title = r.title, content = r.content, user_id = r.user_id,
+            likes = list(r.likes), tags = list(r.tags), created = r.created,
+            version = r.version) for r in rows])
+
+    def load_comments(self, rows):
+        '''Writes generated Comments with one batch put.  See load_users'''
+        by_post = {}
+        for r in rows:
+            by_post.setdefault(r.post_id, []).append(r.id)
+        parents = {}
+        for post_id, ids in by_post.items():
+            parents[post_id] = self.db.Key.from_path(
+                "Post", post_id, parent = self.data.blog_key())
+            self._reserve_ids("Comment", parents[post_id], ids)
+        self.db.put([self.data.Comment(
+            key = self.db.Key.from_path("Comment", r.id,
+                                        parent = parents[r.post_id]),
+            user_id = r.user_id, content = r.content, created = r.created,
+            version = r.version) for r in rows])
+
+    def register_user(self, name, pw, email = None):
+        u = self.data.User.register(name, pw, email)
+        u.put()
+        return u
+
+    def login(self, name, pw):
+        return self.data.User.login(name, pw)
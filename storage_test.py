@@ -0,0 +1,95 @@
+import pytest
+
+import cache
+import counters
+import storage
+
+
+def test_posts_comments_and_likes(backend):
+    s = backend
+    u = s.register_user("alice", "Passw0rd")
+    assert s.login("alice", "Passw0rd").key().id() == u.key().id()
+    assert s.login("alice", "wrong") is None
+
+    p = s.create_post("Title", "Body", u.key().id())
+    p.add_like(42)
+    s.save_post(p)
+    s.create_comment(p, u.key().id(), "First")
+    s.create_comment(p, u.key().id(), "Second")
+
+    p = s.get_post(p.key().id())
+    assert p.likes == [u.key().id(), 42]
+    assert p.version == 3
+    assert [c.content for c in s.get_comments(p)] == ["Second", "First"]
+
+    missing = p.key().id() + 100
+    assert s.get_posts([missing, p.key().id()])[0] is None
+    s.delete_post(p)
+    assert s.get_post(p.key().id()) is None
+
+
+def test_pages_and_bad_cursors(backend):
+    s = backend
+    uid = s.register_user("alice", "Passw0rd").key().id()
+    for i in range(3):
+        s.create_post("P%d" % i, "Body", uid)
+
+    first, cursor = s.recent_posts_page(2)
+    assert [p.title for p in first] == ["P2", "P1"]
+    rest, end = s.recent_posts_page(2, cursor)
+    assert [p.title for p in rest] == ["P0"] and end is None
+    with pytest.raises(storage.InvalidCursorError):
+        s.recent_posts_page(2, "bogus")
+
+
+def test_comment_versions(backend):
+    s = backend
+    uid = s.register_user("alice", "Passw0rd").key().id()
+    p = s.create_post("Title", "Body", uid)
+    first = s.create_comment(p, uid, "First")
+    s.create_comment(p, uid, "Second")
+    first.content = "Edited"
+    s.save_comment(first)
+
+    assert s.get_post(p.key().id()).version == 3
+    assert [c.content for c in s.changed_comments(p, 1)] == [
+        "Second", "Edited"]
+
+
+def test_app(app):
+    app.post("/blog/signup", {"username": "bob", "pwd1": "Passw0rd",
+                              "pwd2": "Passw0rd"})
+    response = app.post("/blog/newpost", {"title": "Hello",
+                                          "content": "World"})
+    post_url = response.headers["Location"]
+
+    app.post(post_url, {"action": "add_comment",
+                        "comment_content": "Nice post"})
+    response = app.get(post_url)
+    assert "Hello" in response
+    assert "Nice post" in response
+    assert "Hello" in app.get("/blog")
+    app.get("/blog/%d" % 2 ** 64, status = 404)
+
+
+def test_warmup(app, monkeypatch):
+    board = [{"id": 1, "title": "Hot", "views": 9}]
+    cache.client().set(counters.LEADERBOARD_KEY, board)
+    monkeypatch.setattr(counters, "_popular", None)
+    assert app.get("/_ah/warmup").body == "OK"
+    # The first page render finds the leaderboard in process
+    monkeypatch.setattr(counters.cache, "client", None)
+    assert counters.popular_posts() == board
+
+
+def test_sqlite_file_database(tmpdir):
+    import sqlite_storage
+    path = str(tmpdir.join("blog.db"))
+    s = sqlite_storage.SqliteStorage(path)
+    uid = s.register_user("alice", "Passw0rd").key().id()
+    s.create_post("Title", "Body", uid, ["a"])
+    s.pool.close()
+
+    s = sqlite_storage.SqliteStorage(path)
+    assert s.recent_posts(1)[0].tags == ["a"]
+    s.pool.close()